@@ -1,14 +1,32 @@
 import argparse
+import asyncio
 import collections
+import contextlib
 import datetime
+import functools
 import hashlib
+import inspect
 import logging
 import os
 import random
 import shutil
+import socket
 import subprocess
+import sys
 import time
 
+from . import benchmark
+from . import history
+from . import incremental
+from . import logs
+from . import monitoring
+from . import parallel
+from . import profiling
+from . import querycache
+from . import server
+from . import tracing
+from . import workqueue
+
 # postgres is required only when `PostgresApp` is instantiated
 try:
     from . import postgres
@@ -25,7 +43,17 @@ class Operation:
     Container of ETL descriptions.
     """
 
-    def __init__(self, name: str, func, run_by_default: bool = True):
+    def __init__(
+        self,
+        name: str,
+        func,
+        run_by_default: bool = True,
+        depends_on: list = None,
+        input_files: list = None,
+        input_tables: list = None,
+        config=None,
+        memory=None,
+    ):
         """
         Creates an ETL metadata object.
 
@@ -33,18 +61,54 @@ class Operation:
             ```python
             ops = [
                     Operation("my_operation", my_function),
-                    Operation("another_operation", functools.partial(function_which_requires_arguments, first_arg, second_arg))
+                    Operation("another_operation", functools.partial(function_which_requires_arguments, first_arg, second_arg)),
+                    Operation("final_operation", final_function, depends_on=["my_operation", "another_operation"]),
                 ]
             ```
 
         parameters:
             - name (str): the unique name of this operation
-            - func (callable): the function to call in order to execute this operation
+            - func (callable): the function to call in order to execute this operation; may be a coroutine
+                function (`async def`), in which case it runs on the event loop of the application concurrently with
+                other coroutine operations
             - run_by_default (boolean): whether to run this operation if no arguments are provided
+            - depends_on (list): names of operations which must be completed before this operation is started;
+                dependencies which are not selected for running are ignored
+            - input_files (list): paths of files read by this operation; used to detect changes in incremental mode
+            - input_tables (list): names of database tables read by this operation; used to detect changes in
+                incremental mode
+            - config: configuration values used by this operation; used to detect changes in incremental mode
+            - memory (int or str): estimated peak memory of this operation in bytes, or a size such as "8G"; used
+                to schedule concurrent operations within a memory budget. If omitted, the peak memory of previous
+                runs is used.
         """
         self.name = name
         self.func = func
         self.run_by_default = run_by_default
+        self.depends_on = list(depends_on or [])
+        self.input_files = list(input_files or [])
+        self.input_tables = list(input_tables or [])
+        self.config = config
+        self.memory = monitoring.parse_size(memory) if memory is not None else None
+
+    def execute(self, app):
+        """
+        Executes this operation; called by `app`.
+        """
+        return self.func()
+
+    def describe(self) -> str:
+        """
+        Returns a text which changes when the implementation of this operation changes.
+        """
+        return incremental.describe_callable(self.func)
+
+    @property
+    def is_coroutine(self) -> bool:
+        """
+        Whether `func` is a coroutine function.
+        """
+        return inspect.iscoroutinefunction(self.func) or inspect.iscoroutinefunction(getattr(self.func, "func", None))
 
     def as_tuple(self):
         return (self.name, self.func, self.run_by_default)
@@ -56,11 +120,94 @@ class Operation:
         return self.as_tuple().__getitem__(idx)
 
 
+class PartitionedOperation(Operation):
+    """
+    Operation which is executed for a number of partitions of the data in
+    parallel, followed by a merge step.
+    """
+
+    def __init__(self, name: str, func, partitions, merge=None, jobs: int = None, **kwargs):
+        """
+        Creates a partitioned ETL metadata object.
+
+        Each partition is processed in a separate child process, with its own
+        database connection and a random seed derived from the name of the
+        operation and the partition.
+
+        Examples of use:
+            ```python
+            ops = [
+                    PartitionedOperation("load_months", load_month, partitions=["2020-01", "2020-02", "2020-03"]),
+                    PartitionedOperation("count", count_rows, partitions=lambda: list_files(datadir), merge=sum),
+                ]
+            ```
+
+        parameters:
+            - name (str): the unique name of this operation
+            - func (callable): the function to call for each partition; it takes the partition as its only argument,
+                and its return value must be picklable
+            - partitions (list or callable): the partitions, e.g. date ranges, key ranges or file names, or a function
+                which returns the partitions
+            - merge (callable): the function to call with the list of results of all partitions, in the order of
+                the partitions
+            - jobs (int): the maximum number of partitions to process concurrently (default: number of CPUs)
+            - other arguments are passed to `Operation`
+        """
+        super().__init__(name, func, **kwargs)
+        self.partitions = partitions
+        self.merge = merge
+        self.jobs = jobs
+
+    def execute(self, app):
+        partitions = self.partitions() if callable(self.partitions) else list(self.partitions)
+        results = parallel.map_forked(
+            functools.partial(app.run_partition, self), partitions, self.jobs or os.cpu_count()
+        )
+        return self.merge(results) if self.merge is not None else None
+
+    def describe(self) -> str:
+        return "\n".join([
+            super().describe(),
+            incremental.describe_callable(self.partitions) if callable(self.partitions) else repr(self.partitions),
+            incremental.describe_callable(self.merge) if self.merge is not None else "",
+        ])
+
+    @property
+    def is_coroutine(self) -> bool:
+        return False
+
+
+def order_operations(ops: list) -> list:
+    """
+    Sorts operations such that every operation comes after its dependencies.
+    The original order is retained as much as possible.
+
+    Dependencies on operations which are not in `ops` are ignored.
+    """
+    names = [op.name for op in ops]
+    remaining = list(ops)
+    done = set()
+    ordered = []
+    while remaining:
+        ready = [op for op in remaining if all(dep in done or dep not in names for dep in op.depends_on)]
+        if not ready:
+            raise ValueError(f'circular dependency between operations: {", ".join(op.name for op in remaining)}')
+        ordered.append(ready[0])
+        done.add(ready[0].name)
+        remaining.remove(ready[0])
+
+    return ordered
+
+
 class BasicApp:
     """
     Base class for a basic application.
     """
-    def __init__(self, app_name: str, operations: list):
+    # whether `describe_table()` and `table_size()` are implemented, so that
+    # input tables of operations are taken into account
+    supports_input_tables = False
+
+    def __init__(self, app_name: str, operations: list, default_resultdir: str = "."):
         """
         Arguments:
             - app_name: a short text describing the app
@@ -72,9 +219,22 @@ class BasicApp:
                 runtime to retrieve the list of `Operation`s. The function
                 should accept exactly one argument, namely a `BasicApp`
                 instance, and return a list of `Operation`s.
+            - default_resultdir: filesystem directory where results may be written; may be overridden by command line
+                argument.
         """
         self.app_name = app_name
         self.operations = operations
+        self.ledger = None
+        self.checkpoint = None
+        self.report = None
+        self._fingerprints = {}
+        self._unprofiled = set()
+        # resident memory inherited from the main process by a forked operation
+        self._inherited_rss = None
+        self._event_loop = None
+        self._queue_logging = None
+        self._log_settings = None
+        self._log_stream = None
 
         self.parser = argparse.ArgumentParser(description=app_name)
         ops = self.parser.add_argument_group("operations")
@@ -85,7 +245,110 @@ class BasicApp:
             nargs="*",
             metavar="OPERATION",
         )
+        ops.add_argument(
+            "--jobs",
+            "-j",
+            help="number of operations to run concurrently in child processes (default: 1)",
+            type=int,
+            default=1,
+            metavar="N",
+        )
+        ops.add_argument(
+            "--memory-budget",
+            help="start concurrent operations only while the sum of their estimated peak memory stays below SIZE "
+            "(e.g. 48G); operations without an estimate or history count as zero",
+            metavar="SIZE",
+        )
+        ops.add_argument(
+            "--incremental",
+            help="skip operations which are unchanged since their last successful run",
+            action="store_true",
+        )
+        ops.add_argument(
+            "--resume",
+            help="skip operations which were completed in the previous run, unless they have changed",
+            action="store_true",
+        )
+        ops.add_argument(
+            "--profile",
+            help="profile operations and write the results to `profiles` in the result directory "
+            "(by default profile all operations)",
+            nargs="*",
+            metavar="OPERATION",
+        )
+        ops.add_argument(
+            "--sample-profile",
+            help="sample the stacks of all operations HZ times per second and write the results to `profiles` in the "
+            "result directory",
+            type=float,
+            metavar="HZ",
+        )
 
+        ops.add_argument(
+            "--top-statements",
+            help="number of slowest and most frequent database statements to report per operation (default: 10)",
+            type=int,
+            default=10,
+            metavar="N",
+        )
+        ops.add_argument(
+            "--trace",
+            help="write a timeline of operations, queries and file reads to FILE in Chrome trace event format",
+            metavar="FILE",
+        )
+
+        bench = self.parser.add_argument_group("benchmark")
+        bench.add_argument(
+            "--benchmark",
+            help="run the selected operations repeatedly in this process and report the distribution of their "
+            "resource usage",
+            action="store_true",
+        )
+        bench.add_argument(
+            "--repeat", help="number of measured repetitions (default: 10)", type=int, default=10, metavar="N"
+        )
+        bench.add_argument(
+            "--warmup", help="number of repetitions before measuring (default: 1)", type=int, default=1, metavar="K"
+        )
+        bench.add_argument(
+            "--baseline",
+            help="compare the benchmark to the results in FILE; raise an error if a regression is found",
+            metavar="FILE",
+        )
+        bench.add_argument(
+            "--save-baseline", help="write the benchmark results to FILE", metavar="FILE"
+        )
+
+        hist = self.parser.add_argument_group("history")
+        hist.add_argument(
+            "--history-report",
+            help="compare the latest timings of each operation to its rolling baseline, and exit",
+            action="store_true",
+        )
+        hist.add_argument(
+            "--history-window",
+            help="number of previous runs in the baseline (default: 10)",
+            type=int,
+            default=10,
+            metavar="N",
+        )
+        hist.add_argument(
+            "--history-threshold",
+            help="flag operations whose runtime differs from the baseline by more than this factor (default: 1.5)",
+            type=float,
+            default=1.5,
+            metavar="FACTOR",
+        )
+
+        self.parser.add_argument(
+            "--serve",
+            help="keep running and accept run requests on a Unix socket at PATH; "
+            "use `python -m boilerplate.server PATH ARGS...` to send a request",
+            metavar="PATH",
+        )
+        self.parser.add_argument(
+            "--resultdir", help=f"where to store results (default: {default_resultdir})", default=default_resultdir
+        )
         self.parser.add_argument(
             "-v", help="increases verbosity", action="count", default=0
         )
@@ -93,6 +356,32 @@ class BasicApp:
             "-q", help="decreases verbosity", action="count", default=0
         )
 
+        log = self.parser.add_argument_group("logging")
+        log.add_argument(
+            "--log-max-size",
+            help="rotate the log file when it exceeds SIZE megabytes (default: 100)",
+            type=float,
+            default=100,
+            metavar="SIZE",
+        )
+        log.add_argument(
+            "--log-rotate-interval",
+            help="rotate the log file every HOURS hours",
+            type=float,
+            metavar="HOURS",
+        )
+        log.add_argument(
+            "--log-backups", help="number of rotated log files to keep (default: 5)", type=int, default=5, metavar="N"
+        )
+        log.add_argument("--log-compress", help="compress rotated log files", action="store_true")
+        log.add_argument(
+            "--log-buffer",
+            help="maximum number of log records waiting to be written; further records are dropped (default: 10000)",
+            type=int,
+            default=10000,
+            metavar="N",
+        )
+
     def __enter__(self):
         return self
 
@@ -100,9 +389,51 @@ class BasicApp:
         self.close()
 
     def close(self):
-        pass
+        if self._event_loop is not None:
+            self._event_loop.close()
+            self._event_loop = None
+        if self._queue_logging is not None:
+            self._queue_logging.stop()
+            self._queue_logging = None
+            self._log_settings = None
+
+    @property
+    def event_loop(self):
+        """
+        The asyncio event loop on which coroutine operations run. The loop is
+        shared by all operations, so that asynchronous resources may be
+        reused.
+        """
+        if self._event_loop is None:
+            self._event_loop = asyncio.new_event_loop()
 
-    def setup_logging(self, file_path: str, level_increase: int):
+        return self._event_loop
+
+    def setup_logging(
+        self,
+        file_path: str,
+        level_increase: int,
+        max_bytes: int = 0,
+        backup_count: int = 5,
+        rotate_interval: float = None,
+        compress: bool = False,
+        buffer_size: int = 10000,
+        stream=None,
+    ):
+        """
+        Sets up logging to the terminal and to a file. Records are written by
+        a background thread; see `boilerplate.logs`.
+
+        Arguments:
+            - file_path: path of the log file
+            - level_increase: verbosity relative to the default log level
+            - max_bytes: rotate the log file when it exceeds this size (0: no size limit)
+            - backup_count: number of rotated log files to keep
+            - rotate_interval: rotate the log file after this many seconds (`None`: no time limit)
+            - compress: compress rotated log files in the background
+            - buffer_size: maximum number of records waiting to be written
+            - stream: the terminal stream (default: `sys.stderr`)
+        """
         self._loglevel = max(
             logging.DEBUG, min(logging.CRITICAL, DEFAULT_LOGLEVEL - level_increase * 10)
         )
@@ -111,29 +442,54 @@ class BasicApp:
         log_format = "[%(asctime)-15s %(levelname)s] %(name)s: %(message)s"
         fmt = logging.Formatter(log_format)
 
-        ch = logging.StreamHandler()
+        ch = logging.StreamHandler(stream)
         ch.setFormatter(fmt)
         ch.setLevel(self._loglevel)
-        logging.getLogger().addHandler(ch)
 
-        # setup a file handler
-        if os.path.exists(file_path):
-            os.rename(file_path, f"{file_path}.0")
-        fh = logging.FileHandler(file_path, mode="w")
+        # setup a file handler; an existing log file is rotated
+        fh = logs.RotatingFileHandler(
+            file_path, max_bytes=max_bytes, backup_count=backup_count, interval=rotate_interval, compress=compress
+        )
         fh.setFormatter(fmt)
         fh.setLevel(logging.INFO)
-        logging.getLogger().addHandler(fh)
+
+        self._queue_logging = logs.QueueLogging([ch, fh], maxsize=buffer_size)
+        self._queue_logging.start()
 
         logging.getLogger("").setLevel(self._loglevel)
 
-    def prepare(self):
+    def prepare(self, args: list = None):
         """
         This is called before the application is run.
         This parses the required args on start and sets up logging
+
+        Arguments:
+            - args: command line arguments (default: `sys.argv`)
         """
 
-        self.args = self.parser.parse_args()
-        self.setup_logging(f"{self.app_name}.log", self.args.v - self.args.q)
+        self.args = self.parser.parse_args(args)
+
+        # when serving multiple runs, logging is set up again only if its settings change
+        log_settings = dict(
+            level_increase=self.args.v - self.args.q,
+            max_bytes=int(self.args.log_max_size * 2**20),
+            backup_count=self.args.log_backups,
+            rotate_interval=self.args.log_rotate_interval * 3600 if self.args.log_rotate_interval else None,
+            compress=self.args.log_compress,
+            buffer_size=self.args.log_buffer,
+        )
+        if log_settings != self._log_settings:
+            if self._queue_logging is not None:
+                self._queue_logging.stop()
+            else:  # the terminal stream of the first run; later runs of a server may redirect `sys.stderr`
+                self._log_stream = sys.stderr
+            self.setup_logging(f"{self.app_name}.log", stream=self._log_stream, **log_settings)
+            self._log_settings = log_settings
+
+        self.resultdir = self.args.resultdir
+        self.report = monitoring.RunReport(os.path.join(self.resultdir, "report"))
+        self.checkpoint = incremental.Ledger(os.path.join(self.resultdir, "run_state.json"))
+        self.ledger = incremental.Ledger(os.path.join(self.resultdir, "ledger.json")) if self.args.incremental else None
 
     def set_random_seed(self, name: str):
         """
@@ -153,14 +509,347 @@ class BasicApp:
         else:
             return self.operations
 
-    def run(self):
+    def fingerprint_operation(self, op) -> str:
+        """
+        Returns a fingerprint of an operation, which changes when its function,
+        its bound arguments, its configuration, its inputs or its
+        dependencies change.
+        """
+        parts = [op.name, op.describe(), incremental.describe_config(op.config)]
+        parts += [incremental.describe_file(path) for path in op.input_files]
+        if self.supports_input_tables:
+            parts += [self.describe_table(table) for table in op.input_tables]
+        ledger = self.ledger if self.ledger is not None else self.checkpoint
+        for dep in op.depends_on:
+            entry = ledger.get(dep)
+            parts.append(f"{dep}:{entry['completed'] if entry is not None else None}")
+
+        return incremental.fingerprint(*parts)
+
+    def is_up_to_date(self, op) -> bool:
+        """
+        Returns `True` if `op` is unchanged since its last successful run, and
+        either running in incremental mode, or resuming a run in which `op`
+        was completed.
+
+        Operations are fingerprinted only in these modes. A run without
+        fingerprints records completed operations without a fingerprint; when
+        such a run is resumed, these operations are considered completed.
+        """
+        if self.ledger is None and not self.args.resume:
+            self._fingerprints[op.name] = None
+            return False
+
+        fingerprint = self._fingerprints[op.name] = self.fingerprint_operation(op)
+        if self.ledger is not None and self.ledger.is_up_to_date(op.name, fingerprint):
+            print(f"Skipping {op.name}: up to date")
+        elif self.args.resume and self.checkpoint.is_up_to_date(op.name, fingerprint, accept_unknown=True):
+            print(f"Skipping {op.name}: completed in previous run")
+        else:
+            return False
+
+        self.report.add(dict(operation=op.name, status="skipped"))
+        return True
+
+    def operation_completed(self, op, result: dict):
+        """
+        This is called in the main process when an operation is completed.
+        """
+        ledgers = [self.checkpoint] if self.ledger is None else [self.checkpoint, self.ledger]
+        for ledger in ledgers:
+            ledger.record(
+                op.name,
+                self._fingerprints[op.name],
+                wall_time=result["wall_time"],
+                cpu_time=result["cpu_time"],
+                peak_rss=result["peak_rss"],
+            )
+
+    def _profile_path(self, op, partition=None) -> str:
+        name = op.name if partition is None else f"{op.name}.{partition}"
+        return os.path.join(self.resultdir, "profiles", name.replace(os.sep, "_"))
+
+    def profile_operation(self, op, partition=None):
+        """
+        Returns a context manager which profiles `op`, or a partition of it,
+        if requested on the command line.
+        """
+        if self.args.profile is None or (self.args.profile and op.name not in self.args.profile):
+            return contextlib.nullcontext()
+        if op.name in self._unprofiled:
+            return contextlib.nullcontext()
+
+        return profiling.profile(self._profile_path(op, partition))
+
+    def sample_operation(self, op, partition=None):
+        """
+        Returns a context manager which runs a sampling profiler for `op`, or
+        a partition of it, if requested on the command line.
+        """
+        if not self.args.sample_profile:
+            return contextlib.nullcontext()
+
+        return profiling.sample(f"{self._profile_path(op, partition)}.sampled", self.args.sample_profile)
+
+    def after_fork(self):
+        """
+        This is called in a child process right after it is forked from the
+        main process. Resources that can not be shared between processes
+        should be released here.
+        """
+        # the event loop and the log writer belong to the parent process
+        self._event_loop = None
+        self._queue_logging = None
+
+    @contextlib.contextmanager
+    def operation_context(self, op):
+        """
+        Context manager for running an operation. Sets the random seed, applies
+        the profilers and measures the resource usage. The record of the
+        operation is added to the run report.
+        """
+        self.set_random_seed(op.name)
+
+        timestr = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print("{} Processing {} ...".format(timestr, op.name))
+
+        record = dict(operation=op.name, status="failed")
+        monitor = monitoring.ResourceMonitor(
+            self.args.top_statements, operation=op.name, inherited_rss=self._inherited_rss
+        )
+        token = monitoring.CURRENT_OPERATION.set(op.name)
+        try:
+            with tracing.span(op.name, "operation"), self.sample_operation(op), self.profile_operation(op):
+                yield record
+            record["status"] = "ok"
+        except BaseException as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            monitoring.CURRENT_OPERATION.reset(token)
+            record.update(monitor.stop())
+            self.report.add(record)
+
+        print(
+            f"Processing {op.name}: {round(record['wall_time'] / 60, 1)} minutes elapsed; "
+            f"{round(record['cpu_time'] / 60, 1)} minutes CPU time"
+        )
+
+    def run_operation(self, op) -> dict:
+        """
+        Run a single operation in the current process. Returns a `dict` with
+        the resource usage of the operation, which is also added to the run
+        report.
+        """
+        with self.operation_context(op) as record:
+            op.execute(self)
+
+        return record
+
+    async def run_operation_async(self, op) -> dict:
+        """
+        Run a coroutine operation. Returns a `dict` with the resource usage of
+        the operation, which is also added to the run report.
+
+        Note that coroutine operations which run concurrently share the state
+        of the `random` package.
+        """
+        with tracing.virtual_thread(op.name), self.operation_context(op) as record:
+            await op.execute(self)
+
+        return record
+
+    def _run_forked_operation(self, op):
+        # like `ForkedCall.peak_rss`, count only the memory used beyond what was inherited
+        monitoring.reset_peak_rss()
+        self._inherited_rss = monitoring.rss()
+        self.after_fork()
+        tracing.name_process(op.name)
+        try:
+            return self.run_operation(op)
+        finally:
+            self.close()
+
+    def process_partition(self, op, partition):
+        """
+        Process a single partition of a `PartitionedOperation` in the current
+        process and return the result.
+        """
+        self.set_random_seed(f"{op.name}:{partition}")
+        LOG.info(f"processing {op.name} partition {partition}")
+        token = monitoring.CURRENT_OPERATION.set(op.name)
+        try:
+            with tracing.span(f"{op.name}[{partition}]", "partition"), \
+                    self.sample_operation(op, partition), self.profile_operation(op, partition):
+                return op.func(partition)
+        finally:
+            monitoring.CURRENT_OPERATION.reset(token)
+
+    def run_partition(self, op, partition):
+        """
+        Process a single partition of a `PartitionedOperation`; this is called
+        in a child process.
+        """
+        self.after_fork()
+        try:
+            return self.process_partition(op, partition)
+        finally:
+            self.close()
+
+    def estimate_memory(self, ops: list, window: int = 5) -> dict:
+        """
+        Returns the estimated peak memory in bytes by operation name. The
+        estimate is the declared memory of the operation if available, or the
+        maximum peak memory of its last `window` runs in the history.
+        """
+        estimates = {op.name: op.memory for op in ops}
+        if any(estimate is None for estimate in estimates.values()):
+            try:
+                store = self.open_history()
+                try:
+                    records = store.load()
+                finally:
+                    store.close()
+            except Exception as e:
+                LOG.warning(f"unable to read history for memory estimates: {e}")
+                records = []
+
+            previous = {}
+            for record in records:
+                if record["peak_rss"] is not None:
+                    previous.setdefault(record["operation"], []).append(record["peak_rss"])
+            for name, estimate in estimates.items():
+                if estimate is None and name in previous:
+                    estimates[name] = max(previous[name][-window:])
+
+        for name, estimate in estimates.items():
+            LOG.info(f"estimated memory of {name}: {'unknown' if estimate is None else f'{estimate / 2**30:.1f} GiB'}")
+
+        return {name: estimate or 0 for name, estimate in estimates.items()}
+
+    def run_scheduled(self, ops: list, jobs: int, memory_budget: int = None):
+        """
+        Run operations in the order of their dependencies. An operation is
+        started as soon as all of its dependencies are completed.
+
+        Coroutine operations run concurrently on the event loop of the
+        application. If `jobs` is 1, other operations run one by one in the
+        current process; otherwise they run in at most `jobs` concurrent child
+        processes.
+
+        If `memory_budget` is given, an operation is started only if the sum
+        of the estimated peak memory of the running operations and the
+        operation does not exceed the budget, or if no other operations are
+        running.
+
+        If an operation fails, no new operations are started and an exception
+        is raised after the running operations have finished.
+        """
+        loop = self.event_loop
+        names = [op.name for op in ops]
+        pending = order_operations(ops)
+        running = {}
+        done = set()
+        errors = []
+        estimates = self.estimate_memory(ops) if memory_budget is not None else None
+
+        # a deterministic profiler covers the whole thread, so coroutine operations can be profiled only if no
+        # other operation runs in this process at the same time
+        coroutines = [op.name for op in ops if op.is_coroutine]
+        concurrent = len(coroutines) > 1 or (coroutines and jobs == 1 and len(coroutines) < len(ops))
+        self._unprofiled = set(coroutines) if concurrent else set()
+        if self.args.profile is not None and concurrent:
+            profiled = [name for name in coroutines if not self.args.profile or name in self.args.profile]
+            if profiled:
+                LOG.warning(
+                    f"not profiling {', '.join(profiled)}: coroutine operations run concurrently with other "
+                    "operations in this process; use --sample-profile, or --run a single operation"
+                )
+
+        def completed(op, result):
+            self.operation_completed(op, result)
+            done.add(op.name)
+
+        while pending or running:
+            for op in list(pending):
+                if errors:
+                    break
+                if not all(dep in done or dep not in names for dep in op.depends_on):
+                    continue
+                if not op.is_coroutine and jobs > 1 and sum(not o.is_coroutine for o in running.values()) >= jobs:
+                    continue
+                if (
+                    estimates is not None
+                    and running
+                    and sum(estimates[o.name] for o in running.values()) + estimates[op.name] > memory_budget
+                ):
+                    continue
+
+                pending.remove(op)
+                if self.is_up_to_date(op):
+                    done.add(op.name)
+                elif op.is_coroutine:
+                    running[loop.create_task(self.run_operation_async(op))] = op
+                elif jobs > 1:
+                    running[parallel.ForkedCall(self._run_forked_operation, op, name=op.name).as_future(loop)] = op
+                else:
+                    # let the coroutine operations start before blocking the event loop
+                    loop.run_until_complete(asyncio.sleep(0))
+                    try:
+                        completed(op, self.run_operation(op))
+                    except Exception as e:
+                        errors.append((op.name, e))
+
+            if not running:
+                break
+
+            finished, _ = loop.run_until_complete(asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED))
+            for future in finished:
+                op = running.pop(future)
+                try:
+                    completed(op, future.result())
+                except Exception as e:
+                    LOG.error(f"operation {op.name} failed", exc_info=e)
+                    errors.append((op.name, e))
+
+        if len(errors) == 1:
+            raise errors[0][1]
+        elif errors:
+            raise RuntimeError(f'operations failed: {", ".join(name for name, e in errors)}')
+
+    def serve(self, path: str):
+        """
+        Keeps the application running and accepts run requests on a Unix
+        socket at `path`, so that imports, configuration and connections stay
+        warm between runs. Requests are handled one at a time.
+
+        Use `python -m boilerplate.server PATH ARGS...` to send a request.
+        """
+        def handle(args):
+            if "--serve" in args:
+                raise ValueError("--serve is not allowed in a request")
+            self.run(args)
+            return 0
+
+        print(f"{self.app_name}: accepting requests on {path}")
+        server.serve(path, handle)
+
+    def run(self, args: list = None):
         """
         Run all or some operations in this application.
+
+        Arguments:
+            - args: command line arguments (default: `sys.argv`)
         """
         # execute before run hook
-        self.prepare()
+        self.prepare(args)
+
+        if self.args.serve:
+            self.serve(self.args.serve)
+            return
 
         ops = self.get_operations()
+        all_names = [op.name for op in ops]
         if self.args.list:
             print(
                 "\n".join(
@@ -169,6 +858,10 @@ class BasicApp:
             )
             return
 
+        if self.args.history_report:
+            self.print_history_report()
+            return
+
         if self.args.run is None:
             ops = [step for step in ops if step.run_by_default]
         else:
@@ -182,29 +875,163 @@ class BasicApp:
                 raise ValueError(f'operations not available: {", ".join(missing_ops)}')
 
         for op in ops:
-            # TODO: This line does not do anything. It calls a function which returns something which is not used
-            self.set_random_seed(op.name)
+            unknown = [dep for dep in op.depends_on if dep not in all_names]
+            if unknown:
+                raise ValueError(f'operation {op.name} depends on unknown operations: {", ".join(unknown)}')
+            if op.input_tables and not self.supports_input_tables:
+                LOG.warning(f"input tables of operation {op.name} are ignored: not supported by this application")
 
-            timestr = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print("{} Processing {} ...".format(timestr, op.name))
+        self.execute_operations(ops)
 
-            t1_start = time.perf_counter()
-            t2_start = time.process_time()
+    def benchmark_operations(self, ops: list, repeat: int, warmup: int) -> dict:
+        """
+        Runs each operation `warmup` times and then `repeat` times while
+        measuring, in the current process. The random seed is reset before
+        each repetition.
 
-            op.func()
+        Returns a `dict` of measurements by operation and metric.
+        """
+        results = {}
+        for op in order_operations(ops):
+            records = []
+            for i in range(warmup + repeat):
+                if op.is_coroutine:
+                    record = self.event_loop.run_until_complete(self.run_operation_async(op))
+                else:
+                    record = self.run_operation(op)
+                if i >= warmup:
+                    records.append(record)
 
-            t1_stop = time.perf_counter()
-            t2_stop = time.process_time()
-            print(
-                f"Processing {op.name}: {round((t1_stop - t1_start) / 60, 1)} minutes elapsed; "
-                f"{round((t2_stop - t2_start) / 60, 1)} minutes CPU time"
-            )
+            results[op.name] = {metric: [record[metric] for record in records] for metric in benchmark.METRICS}
+            for metric in benchmark.METRICS:
+                summary = benchmark.summarize(results[op.name][metric])
+                if summary:
+                    LOG.info(f"benchmark {op.name} {metric}: {summary}")
+
+        return results
+
+    def run_benchmark(self, ops: list):
+        """
+        Benchmarks the operations as requested on the command line, and
+        compares the results to a baseline if available.
+        """
+        results = self.benchmark_operations(ops, self.args.repeat, self.args.warmup)
+        benchmark.save(results, os.path.join(self.resultdir, "benchmark.json"))
+        if self.args.save_baseline:
+            benchmark.save(results, self.args.save_baseline)
+
+        if self.args.baseline:
+            baseline = benchmark.load(self.args.baseline)
+            comparisons = {
+                name: {
+                    metric: benchmark.compare(samples[metric], baseline[name].get(metric, []))
+                    for metric in benchmark.METRICS
+                }
+                for name, samples in results.items()
+                if name in baseline
+            }
+            print(benchmark.format_comparison(comparisons))
+
+            regressions = [
+                f"{name} ({metric})"
+                for name, metrics in comparisons.items()
+                for metric, c in metrics.items()
+                if c["verdict"] == "regression"
+            ]
+            if regressions:
+                raise RuntimeError(f'performance regression: {", ".join(regressions)}')
+        else:
+            for name, samples in results.items():
+                for metric in benchmark.METRICS:
+                    summary = benchmark.summarize(samples[metric])
+                    if summary:
+                        print(
+                            f"{name} {metric}: median {summary['median']:.4g}; "
+                            f"min {summary['min']:.4g}; max {summary['max']:.4g}"
+                        )
+
+    def execute_operations(self, ops: list):
+        """
+        Run the selected operations; this is called by `run()`.
+        """
+        if self.args.benchmark:
+            self.report.start()
+            try:
+                self.run_benchmark(ops)
+            finally:
+                self.report.finish()
+            return
+
+        self.report.start()
+        if not self.args.resume:
+            self.checkpoint.clear()
+        if self.args.trace:
+            tracing.start(self.args.trace)
+        try:
+            memory_budget = monitoring.parse_size(self.args.memory_budget) if self.args.memory_budget else None
+            self.run_scheduled(ops, self.args.jobs, memory_budget)
+        finally:
+            tracing.stop()
+            self.report.finish()
+            self.record_history(ops, self.report.records())
+
+    def open_history(self):
+        """
+        Returns the history of operation timings, which is stored in a SQLite
+        file next to the log file.
+        """
+        return history.SQLiteHistory(f"{self.app_name}.history.sqlite")
+
+    def data_size(self, op) -> int:
+        """
+        Returns the total size of the declared inputs of an operation in bytes.
+        """
+        size = sum(os.path.getsize(path) for path in op.input_files if os.path.exists(path))
+        if self.supports_input_tables:
+            size += sum(self.table_size(table) for table in op.input_tables)
+        return size
+
+    def record_history(self, ops: list, records: list):
+        """
+        Adds the records of executed operations to the history, along with the
+        git revision and the size of their inputs.
+        """
+        ops = {op.name: op for op in ops}
+        run_id = datetime.datetime.now().isoformat()
+        revision = history.git_revision()
+        try:
+            records = [
+                dict(record, run_id=run_id, revision=revision, data_size=self.data_size(ops[record["operation"]]))
+                for record in records
+                if record["status"] != "skipped" and record["operation"] in ops
+            ]
+            store = self.open_history()
+            try:
+                store.add(records)
+            finally:
+                store.close()
+        except Exception as e:
+            LOG.warning(f"unable to record history: {e}")
+
+    def print_history_report(self):
+        store = self.open_history()
+        try:
+            records = store.load()
+        finally:
+            store.close()
+
+        results = history.detect_regressions(
+            records, window=self.args.history_window, threshold=self.args.history_threshold
+        )
+        print(history.format_regressions(results))
 
 
 class PostgresApp(BasicApp):
     """
     Subclass of `BasicApp` which adds Postgres connection management.
     """
+    supports_input_tables = True
+
     def __init__(
         self, app_name: str, operations: list, database_credentials: dict, default_database_schema: str, default_resultdir: str
     ):
@@ -216,31 +1043,173 @@ class PostgresApp(BasicApp):
             - default_database_schema: database schema to be used; may be overridden by command line argument.
             - default_resultdir: filesystem directory where results may be written; may be overridden by command line argument.
         """
-        super().__init__(app_name, operations)
+        super().__init__(app_name, operations, default_resultdir)
 
         assert 'postgres' in globals(), 'postgres not available; try `pip install psycopg2-binary`'
 
         self.database_credentials = database_credentials
         self._pgcon = None
         self._pgseed = None
+        self._pgpool = None
+        self._async_pgpool = None
+        self._queue_con = None
+        self._connection_settings = None
 
         self.parser.add_argument(
-            "--resultdir", help=f"where to store results (default: {default_resultdir})", default=default_resultdir
+            "--sql-schema", help=f"SQL schema used (default: {default_database_schema})", default=default_database_schema
         )
+
         self.parser.add_argument(
-            "--sql-schema", help=f"SQL schema used (default: {default_database_schema})", default=default_database_schema
+            "--pool-size",
+            help="maximum number of connections in the connection pool (default: 8)",
+            type=int,
+            default=8,
+            metavar="N",
         )
 
-    def prepare(self):
-        super().prepare()
-        self.resultdir = self.args.resultdir
+        self.parser.add_argument(
+            "--pool-min-size",
+            help="number of connections opened in advance in the connection pool (default: 1)",
+            type=int,
+            default=1,
+            metavar="N",
+        )
+
+        self.parser.add_argument(
+            "--prepared-statements",
+            help="number of parameterized statements kept prepared per database connection (default: 0, disabled)",
+            type=int,
+            default=0,
+            metavar="N",
+        )
+
+        self.parser.add_argument(
+            "--query-cache-size",
+            help="maximum size of the cache of results of queries executed with `cache=True` (default: 1G)",
+            default="1G",
+            metavar="SIZE",
+        )
+
+        self.parser.add_argument(
+            "--explain-slow",
+            help="write the plans of database statements which take at least SECONDS to `plans` in the result "
+            "directory",
+            type=float,
+            metavar="SECONDS",
+        )
+
+        queue = self.parser.add_argument_group("work queue")
+        queue.add_argument(
+            "--enqueue",
+            help="add the selected operations to the work queue in the database, to be run by workers",
+            action="store_true",
+        )
+        queue.add_argument(
+            "--worker", help="run operations from the work queue in the database", action="store_true"
+        )
+        queue.add_argument(
+            "--poll-interval",
+            help="seconds between attempts to claim work when the queue is busy (default: 5)",
+            type=float,
+            default=5.,
+            metavar="SECONDS",
+        )
+        queue.add_argument(
+            "--lease",
+            help="seconds after which an item of a worker which stopped renewing it may be claimed by another worker "
+            "(default: 300)",
+            type=float,
+            default=300.,
+            metavar="SECONDS",
+        )
+        queue.add_argument(
+            "--max-attempts",
+            help="number of times an item may be claimed before it is considered failed (default: 3)",
+            type=int,
+            default=3,
+            metavar="N",
+        )
+
+    def prepare(self, args: list = None):
+        super().prepare(args)
+        postgres.auto_explain(os.path.join(self.resultdir, "plans"), self.args.explain_slow)
+
+        # when serving multiple runs, connections are kept unless their settings change
+        connection_settings = dict(
+            sql_schema=self.args.sql_schema,
+            resultdir=self.resultdir,
+            pool_size=self.args.pool_size,
+            pool_min_size=self.args.pool_min_size,
+            prepared_statements=self.args.prepared_statements,
+            query_cache_size=self.args.query_cache_size,
+            explain_slow=self.args.explain_slow,
+        )
+        if connection_settings != self._connection_settings:
+            self.close_connections()
+            self._connection_settings = connection_settings
 
     def set_random_seed(self, name: str):
         seed = super().set_random_seed(name)
         self.set_postgres_seed(seed)
         return seed
 
+    def describe_table(self, name: str) -> str:
+        """
+        Describes a table by its object id and its modification counters.
+        """
+        # commit, so that the connection does not stay idle in a transaction
+        # which holds a snapshot of the statistics and locks on the tables
+        with self.pgcon.cursor(commit=True) as cur:
+            cur.execute("SELECT pg_stat_clear_snapshot()")
+            cur.execute(
+                """
+                SELECT c.oid, s.n_tup_ins, s.n_tup_upd, s.n_tup_del
+                FROM pg_class c LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                WHERE c.oid = to_regclass(%s)
+                """,
+                (name,),
+            )
+            row = cur.fetchone()
+
+        return f"{name}:{row}"
+
+    def table_size(self, name: str) -> int:
+        with self.pgcon.cursor(commit=True) as cur:
+            cur.execute("SELECT pg_total_relation_size(to_regclass(%s))", (name,))
+            return cur.fetchone()[0] or 0
+
+    def open_history(self):
+        """
+        Returns the history of operation timings, which is stored in a separate
+        schema so that it is retained when results are cleared. Falls back to
+        a SQLite file if the database is unavailable.
+        """
+        history_schema = f"{self.args.sql_schema}_history"
+        try:
+            postgres.reset_schema(self.database_credentials, history_schema, create_schema=True)
+            con = postgres.pgconnect(self.database_credentials, schema=history_schema, use_wrapper=False)
+        except Exception as e:
+            LOG.warning(f"database unavailable for history; using SQLite instead: {e}")
+            return super().open_history()
+
+        return history.History(con, "operation_history", "%s")
+
+    def after_fork(self):
+        super().after_fork()
+        # the connection of the parent process must not be closed or used by the
+        # child; keep a reference so that it is never deallocated in the child
+        self._parent_pgcon = self._pgcon, self._queue_con, self._pgpool, self._async_pgpool
+        self._pgcon = None
+        self._queue_con = None
+        self._pgpool = None
+        self._async_pgpool = None
+
     def set_postgres_seed(self, seed):
+        if self._pgpool is not None:
+            self._pgpool.seed = seed
+        if self._async_pgpool is not None:
+            self._async_pgpool.seed = seed
+
         if self._pgcon is None:
             self._pgseed = seed  # no connection yet; postpone setting seed
             return
@@ -278,6 +1247,18 @@ class PostgresApp(BasicApp):
         if os.path.exists(self.resultdir):
             shutil.rmtree(self.resultdir)
 
+        # the connection would block dropping the schema, and must be
+        # recreated afterwards to use the new schema
+        if self._pgcon is not None:
+            self._pgcon.close()
+            self._pgcon = None
+        if self._pgpool is not None:
+            self._pgpool.close()
+            self._pgpool = None
+        if self._async_pgpool is not None:
+            self._async_pgpool.close()
+            self._async_pgpool = None
+
         postgres.reset_schema(
             self.database_credentials,
             self.args.sql_schema,
@@ -300,6 +1281,8 @@ class PostgresApp(BasicApp):
             credentials=self.database_credentials,
             schema=self.args.sql_schema,
             use_wrapper=True,
+            prepared_statements=self.args.prepared_statements,
+            result_cache=self.open_result_cache(),
         )
 
         if self._pgseed is not None:  # seed setting postponed; do it now
@@ -318,11 +1301,207 @@ class PostgresApp(BasicApp):
     def run_step(self, func, ctx):
         func()
 
+    def export_query(self, query: str, filename: str, params=None, **kwargs) -> list:
+        """
+        Exports the result of a query to a file in the result directory. See
+        `postgres.Connection.copy_to` for the arguments.
+        """
+        return self.pgcon.copy_to(query, os.path.join(self.resultdir, filename), params, **kwargs)
+
+    def open_result_cache(self):
+        """
+        Returns the cache of query results in the result directory.
+        """
+        return querycache.ResultCache(
+            os.path.join(self.resultdir, "query_cache"), monitoring.parse_size(self.args.query_cache_size)
+        )
+
+    @property
+    def pgpool(self):
+        """
+        Thread safe pool of database connections; creates the pool when needed.
+        Use `app.pgpool.connection()` to check out a connection.
+        """
+        if self._pgpool is None:
+            postgres.reset_schema(
+                self.database_credentials,
+                self.args.sql_schema,
+                create_schema=True,
+                drop_schema=False,
+            )
+            self._pgpool = postgres.ConnectionPool(
+                self.database_credentials,
+                schema=self.args.sql_schema,
+                minconn=min(self.args.pool_min_size, self.args.pool_size),
+                maxconn=self.args.pool_size,
+                seed=self._pgseed,
+                prepared_statements=self.args.prepared_statements,
+                result_cache=self.open_result_cache(),
+            )
+
+        return self._pgpool
+
+    @property
+    def async_pgpool(self):
+        """
+        Pool of asynchronous database connections, for coroutine operations;
+        creates the pool when needed. Use `app.async_pgpool.connection()` to
+        check out a connection.
+        """
+        if self._async_pgpool is None:
+            postgres.reset_schema(
+                self.database_credentials,
+                self.args.sql_schema,
+                create_schema=True,
+                drop_schema=False,
+            )
+            self._async_pgpool = postgres.AsyncConnectionPool(
+                self.database_credentials,
+                schema=self.args.sql_schema,
+                maxconn=self.args.pool_size,
+                seed=self._pgseed,
+            )
+
+        return self._async_pgpool
+
+    @property
+    def work_queue(self):
+        """
+        Work queue in the database schema, with a dedicated connection.
+        """
+        if self._queue_con is None:
+            self.pgcon  # make sure the schema exists
+            self._queue_con = postgres.pgconnect(
+                credentials=self.database_credentials,
+                schema=self.args.sql_schema,
+                autocommit=True,
+            )
+
+        return workqueue.WorkQueue(self._queue_con)
+
+    def enqueue_operations(self, ops: list):
+        """
+        Replaces the contents of the work queue by the operations `ops`. The
+        partitions of a `PartitionedOperation` are added as separate items,
+        followed by a merge item.
+        """
+        queue = self.work_queue
+        queue.create()
+        queue.clear()
+
+        last_item = {}
+        for op in order_operations(ops):
+            dependencies = [last_item[dep] for dep in op.depends_on if dep in last_item]
+            if isinstance(op, PartitionedOperation):
+                partitions = op.partitions() if callable(op.partitions) else list(op.partitions)
+                partition_items = [
+                    queue.add(op.name, workqueue.PARTITION, dependencies, partition_index=i, partition=partition)
+                    for i, partition in enumerate(partitions)
+                ]
+                last_item[op.name] = queue.add(op.name, workqueue.MERGE, partition_items)
+            else:
+                last_item[op.name] = queue.add(op.name, workqueue.OPERATION, dependencies)
+
+        print(f"{len(last_item)} operations added to the work queue")
+
+    def run_worker(self):
+        """
+        Runs items from the work queue until no more items can be claimed.
+        """
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        ops = {op.name: op for op in self.get_operations()}
+        queue = self.work_queue
+        # leases are renewed by a background thread, with a connection of its own
+        lease_con = postgres.pgconnect(
+            credentials=self.database_credentials, schema=self.args.sql_schema, autocommit=True
+        )
+        try:
+            self._run_work_items(queue, workqueue.WorkQueue(lease_con), worker, ops)
+        finally:
+            lease_con.close()
+
+    def _run_work_items(self, queue, lease_queue, worker: str, ops: dict):
+        failed = []
+        while True:
+            item = queue.claim(worker, self.args.lease, self.args.max_attempts)
+            if item is None:
+                expired = queue.expire(self.args.max_attempts)
+                if expired:
+                    LOG.error(f"{expired} work items failed: lease expired after {self.args.max_attempts} attempts")
+                counts = queue.status_counts()
+                if counts.get(workqueue.RUNNING, 0) == 0:
+                    # nothing is running, so no more items will become available
+                    if counts.get(workqueue.PENDING, 0) > 0:
+                        LOG.warning(f"{counts[workqueue.PENDING]} items are blocked by failed items")
+                    break
+
+                time.sleep(self.args.poll_interval)
+                continue
+
+            item_id, name, kind, partition = item
+            lease = workqueue.Lease(lease_queue, item_id, worker, self.args.lease)
+            lease.start()
+            start = time.perf_counter()
+            try:
+                op = ops[name]
+                if kind == workqueue.PARTITION:
+                    result = self.process_partition(op, partition)
+                elif kind == workqueue.MERGE:
+                    with self.operation_context(op) as result:
+                        if op.merge is not None:
+                            op.merge(queue.partition_results(name))
+                elif op.is_coroutine:
+                    result = self.event_loop.run_until_complete(self.run_operation_async(op))
+                else:
+                    result = self.run_operation(op)
+
+                queue.complete(item_id, time.perf_counter() - start, result)
+            except Exception as e:
+                LOG.error(f"work item {item_id} ({kind} of {name}) failed", exc_info=e)
+                queue.fail(item_id, f"{type(e).__name__}: {e}")
+                failed.append(name)
+            finally:
+                lease.stop()
+
+        if failed:
+            raise RuntimeError(f'operations failed: {", ".join(failed)}')
+
+    def execute_operations(self, ops: list):
+        if self.args.enqueue:
+            self.enqueue_operations(ops)
+        elif self.args.worker:
+            # workers may share the result directory
+            self.report = monitoring.RunReport(
+                os.path.join(self.resultdir, f"report-{socket.gethostname()}-{os.getpid()}")
+            )
+            self.report.start()
+            try:
+                self.run_worker()
+            finally:
+                self.report.finish()
+        else:
+            super().execute_operations(ops)
+
     def close(self):
         super().close()
+        self.close_connections()
+
+    def close_connections(self):
+        """
+        Closes the database connections and connection pools.
+        """
         if self._pgcon is not None:
             self._pgcon.close()
             self._pgcon = None
+        if self._queue_con is not None:
+            self._queue_con.close()
+            self._queue_con = None
+        if self._pgpool is not None:
+            self._pgpool.close()
+            self._pgpool = None
+        if self._async_pgpool is not None:
+            self._async_pgpool.close()
+            self._async_pgpool = None
 
 
 class StepFunction(collections.namedtuple("StepFunction", ["func", "args"])):
@@ -0,0 +1,120 @@
+"""
+Benchmarking of operations: statistics of repeated measurements, and
+comparison against a baseline with a Mann-Whitney U test.
+"""
+import json
+import logging
+import math
+import os
+import statistics
+
+
+LOG = logging.getLogger(__name__)
+
+METRICS = ["wall_time", "cpu_time", "peak_rss"]
+
+
+def summarize(samples: list) -> dict:
+    """
+    Returns summary statistics of a list of measurements.
+    """
+    samples = [x for x in samples if x is not None]
+    if not samples:
+        return {}
+
+    return dict(
+        n=len(samples),
+        min=min(samples),
+        median=statistics.median(samples),
+        mean=statistics.mean(samples),
+        stdev=statistics.stdev(samples) if len(samples) > 1 else 0.,
+        max=max(samples),
+    )
+
+
+def mann_whitney_u(a: list, b: list) -> float:
+    """
+    Returns the two-sided p-value of the Mann-Whitney U test of samples `a`
+    and `b`, using the normal approximation with tie correction.
+    """
+    n1, n2 = len(a), len(b)
+    if n1 == 0 or n2 == 0:
+        return 1.
+
+    # rank the pooled samples, using average ranks for ties
+    pooled = sorted([(x, 0) for x in a] + [(x, 1) for x in b])
+    ranks = [0.] * len(pooled)
+    tie_term = 0
+    i = 0
+    while i < len(pooled):
+        j = i
+        while j + 1 < len(pooled) and pooled[j + 1][0] == pooled[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        tie_term += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+
+    r1 = sum(rank for rank, (x, group) in zip(ranks, pooled) if group == 0)
+    u = r1 - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    if sigma == 0:
+        return 1.
+
+    z = (abs(u - n1 * n2 / 2) - .5) / sigma  # with continuity correction
+    return min(1., math.erfc(max(z, 0.) / math.sqrt(2)))
+
+
+def compare(samples: list, baseline_samples: list, alpha: float = .05, threshold: float = .05) -> dict:
+    """
+    Compares measurements to baseline measurements.
+
+    A difference is significant if the p-value of the Mann-Whitney U test is
+    below `alpha` and the medians differ by more than a fraction `threshold`.
+    """
+    samples = [x for x in samples if x is not None]
+    baseline_samples = [x for x in baseline_samples if x is not None]
+    if not samples or not baseline_samples:
+        return dict(verdict="no data")
+
+    median = statistics.median(samples)
+    baseline_median = statistics.median(baseline_samples)
+    ratio = median / baseline_median if baseline_median > 0 else math.inf
+    p = mann_whitney_u(samples, baseline_samples)
+    if p < alpha and ratio > 1 + threshold:
+        verdict = "regression"
+    elif p < alpha and ratio < 1 - threshold:
+        verdict = "improvement"
+    else:
+        verdict = "unchanged"
+
+    return dict(median=median, baseline_median=baseline_median, ratio=ratio, p_value=p, verdict=verdict)
+
+
+def load(path: str) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save(results: dict, path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def format_comparison(comparisons: dict) -> str:
+    """
+    Formats the comparisons by operation and metric as a table.
+    """
+    lines = [f"{'operation':30} {'metric':10} {'median':>12} {'baseline':>12} {'ratio':>7} {'p-value':>8}  verdict"]
+    for op_name, metrics in comparisons.items():
+        for metric, c in metrics.items():
+            if "median" not in c:
+                lines.append(f"{op_name:30} {metric:10} {'':>12} {'':>12} {'':>7} {'':>8}  {c['verdict']}")
+            else:
+                lines.append(
+                    f"{op_name:30} {metric:10} {c['median']:12.4g} {c['baseline_median']:12.4g} {c['ratio']:7.3f} "
+                    f"{c['p_value']:8.4f}  {c['verdict']}"
+                )
+    return "\n".join(lines)
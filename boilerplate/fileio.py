@@ -2,6 +2,7 @@ import hashlib
 import io
 import logging
 
+from . import tracing
 
 LOG = logging.getLogger(__name__)
 
@@ -12,7 +13,7 @@ def load_hashtable(path):
     Returns a `dict` object with filenames as keys and digests as values.
     """
     result = {}
-    with open(path, 'r') as f:
+    with tracing.span('load_hashtable', 'io', path=path), open(path, 'r') as f:
         for line in f:
             hashval, filename = line.split('  ', 1)
             result[filename.rstrip()] = hashval
@@ -35,7 +36,7 @@ def assert_match(found, expected, path, algorithm, on_mismatch):
 
 def check_file(path, expected_digest, algorithm='sha256', on_mismatch='raise'):
     m = hashlib.new(algorithm)
-    with open(path, 'rb') as f:
+    with tracing.span('check_file', 'io', path=path), open(path, 'rb') as f:
         m.update(f.read())
 
     assert_match(m.hexdigest(), expected_digest, path, algorithm, on_mismatch)
@@ -61,6 +62,7 @@ class sha256_open:
             assert illegal_mode not in self._mode, f'mode {illegal_mode} not supported'
 
     def __enter__(self):
+        self._trace_start = tracing.now()
         self._f = open(self.path, 'br')
         self._m = hashlib.sha256()
 
@@ -91,6 +93,7 @@ class sha256_open:
     def close(self):
         self.check_digest()
         self._f.close()
+        tracing.complete('sha256_open', 'io', self._trace_start, path=self.path)
 
     def __getattr__(self, name):
         return eval(f'self._f.{name}')
@@ -101,3 +104,4 @@ class sha256_open:
                 self.check_digest()
         finally:
             self._f.close()
+            tracing.complete('sha256_open', 'io', self._trace_start, path=self.path)
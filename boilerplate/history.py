@@ -0,0 +1,144 @@
+"""
+Historical record of operation timings, and detection of operations whose
+runtime deviates from their rolling baseline.
+"""
+import logging
+import os
+import sqlite3
+import statistics
+import subprocess
+
+
+LOG = logging.getLogger(__name__)
+
+COLUMNS = ["run_id", "revision", "operation", "status", "start", "wall_time", "cpu_time", "peak_rss", "data_size"]
+
+
+def git_revision(path: str = ".") -> str:
+    """
+    Returns the git revision of the working directory, or `None` if not available.
+    """
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=path, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=path,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return f"{revision}-dirty" if dirty else revision
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class History:
+    """
+    Table of operation timings in a DB-API database.
+    """
+    def __init__(self, con, table: str, placeholder: str):
+        """
+        Arguments:
+            - con: database connection
+            - table: (qualified) name of the history table
+            - placeholder: the parameter placeholder of the database driver
+        """
+        self.con = con
+        self.table = table
+        self._placeholder = placeholder
+        self.create()
+
+    def _execute(self, query: str, args=()):
+        cur = self.con.cursor()
+        try:
+            cur.execute(query, args)
+            return cur.fetchall() if cur.description is not None else None
+        finally:
+            cur.close()
+
+    def create(self):
+        self._execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                run_id TEXT NOT NULL,
+                revision TEXT,
+                operation TEXT NOT NULL,
+                status TEXT NOT NULL,
+                start TEXT,
+                wall_time DOUBLE PRECISION,
+                cpu_time DOUBLE PRECISION,
+                peak_rss BIGINT,
+                data_size BIGINT
+            )
+        """)
+        self.con.commit()
+
+    def add(self, records: list):
+        """
+        Adds records, which are `dict`s with keys as in `COLUMNS`.
+        """
+        placeholders = ", ".join([self._placeholder] * len(COLUMNS))
+        for record in records:
+            self._execute(
+                f"INSERT INTO {self.table} ({', '.join(COLUMNS)}) VALUES ({placeholders})",
+                tuple(record.get(column) for column in COLUMNS),
+            )
+        self.con.commit()
+
+    def load(self) -> list:
+        """
+        Returns all records of successful operations, oldest first.
+        """
+        rows = self._execute(
+            f"SELECT {', '.join(COLUMNS)} FROM {self.table} WHERE status = 'ok' ORDER BY start"
+        )
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def close(self):
+        self.con.close()
+
+
+class SQLiteHistory(History):
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        super().__init__(sqlite3.connect(path), "operation_history", "?")
+
+
+def detect_regressions(records: list, metric: str = "wall_time", window: int = 10, threshold: float = 1.5,
+                       min_runs: int = 3) -> list:
+    """
+    Compares the latest run of each operation to the median of its `window`
+    previous runs. An operation is flagged if the ratio exceeds `threshold`,
+    or if it falls below `1 / threshold` (which may indicate that work was
+    skipped).
+
+    Returns a list of `dict`s with the operation, the latest value, the
+    baseline, the ratio and whether it was flagged.
+    """
+    by_operation = {}
+    for record in records:
+        if record.get(metric) is not None:
+            by_operation.setdefault(record["operation"], []).append(record)
+
+    results = []
+    for name, op_records in by_operation.items():
+        latest = op_records[-1]
+        previous = [record[metric] for record in op_records[:-1][-window:]]
+        if len(previous) < min_runs:
+            results.append(dict(operation=name, latest=latest[metric], revision=latest["revision"], baseline=None,
+                                ratio=None, flagged=False))
+            continue
+
+        baseline = statistics.median(previous)
+        ratio = latest[metric] / baseline if baseline > 0 else None
+        flagged = ratio is not None and (ratio > threshold or ratio < 1 / threshold)
+        results.append(dict(operation=name, latest=latest[metric], revision=latest["revision"], baseline=baseline,
+                            ratio=ratio, flagged=flagged))
+
+    return results
+
+
+def format_regressions(results: list) -> str:
+    lines = [f"{'operation':30} {'revision':14} {'latest':>10} {'baseline':>10} {'ratio':>7}"]
+    for r in results:
+        baseline = f"{r['baseline']:10.4g}" if r["baseline"] is not None else f"{'-':>10}"
+        ratio = f"{r['ratio']:7.2f}" if r["ratio"] is not None else f"{'-':>7}"
+        flag = "  <-- deviates from baseline" if r["flagged"] else ""
+        lines.append(f"{r['operation']:30} {str(r['revision']):14} {r['latest']:10.4g} {baseline} {ratio}{flag}")
+    return "\n".join(lines)
@@ -0,0 +1,181 @@
+"""
+Support for incremental runs: operations are fingerprinted and the
+fingerprints of completed operations are kept in a ledger, so that operations
+which have not changed since their last successful run can be skipped.
+"""
+import collections.abc
+import datetime
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import re
+import types
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _describe_value(value) -> str:
+    # memory addresses differ between runs and should not affect the fingerprint
+    return re.sub(r" at 0x[0-9a-fA-F]+", "", repr(value))
+
+
+def _describe_code(code: types.CodeType) -> str:
+    parts = [code.co_code.hex(), repr(code.co_names)]
+    for const in code.co_consts:
+        parts.append(_describe_code(const) if isinstance(const, types.CodeType) else _describe_value(const))
+    return "|".join(parts)
+
+
+def _describe_class(cls: type) -> str:
+    try:
+        return inspect.getsource(cls)
+    except (OSError, TypeError):  # built in or defined interactively
+        return _describe_value(cls)
+
+
+def describe_callable(func) -> str:
+    """
+    Returns a text which changes when the implementation of `func` or its
+    bound arguments change.
+
+    The source code is used if available, otherwise the byte code. The bound
+    arguments of `functools.partial` objects and `StepFunction` objects,
+    default arguments and closure variables are included; the instance of a
+    bound method is not.
+    """
+    if isinstance(func, functools.partial):
+        return "partial({}, {}, {})".format(
+            describe_callable(func.func),
+            ", ".join(_describe_value(arg) for arg in func.args),
+            ", ".join(f"{key}={_describe_value(value)}" for key, value in sorted(func.keywords.items())),
+        )
+    elif isinstance(func, types.MethodType):
+        return describe_callable(func.__func__)
+    elif hasattr(func, "func") and hasattr(func, "args"):  # StepFunction
+        return f"{type(func).__name__}({describe_callable(func.func)}, {_describe_value(func.args)})"
+    elif isinstance(func, type):
+        return _describe_class(func)
+    elif not inspect.isfunction(func) and hasattr(func, "__call__") and not inspect.isbuiltin(func):
+        call = type(func).__call__
+        if inspect.isfunction(call):
+            return f"{_describe_value(func)}: {describe_callable(call)}"
+        # implemented in C (slot wrapper, method descriptor), e.g. `operator.methodcaller`
+        return _describe_value(func)
+
+    code = getattr(func, "__code__", None)
+    try:
+        desc = inspect.getsource(func)
+    except (OSError, TypeError):
+        desc = _describe_code(code) if code is not None else _describe_value(func)
+
+    # default arguments and closure variables act as bound arguments
+    if getattr(func, "__defaults__", None):
+        desc += f"\ndefaults: {_describe_value(func.__defaults__)}"
+    for name, cell in zip(code.co_freevars if code is not None else [], getattr(func, "__closure__", None) or []):
+        try:
+            desc += f"\n{name}: {_describe_value(cell.cell_contents)}"
+        except ValueError:  # empty cell
+            pass
+
+    return desc
+
+
+def _config_values(value):
+    if isinstance(value, collections.abc.Mapping):
+        return {str(key): _config_values(value[key]) for key in value}
+    if isinstance(value, collections.abc.Sequence) and not isinstance(value, (str, bytes)):
+        return [_config_values(item) for item in value]
+    return value
+
+
+def describe_config(config) -> str:
+    """
+    Returns a text which changes when any value of `config` changes. Mappings
+    (including `confidence.Configuration`) and sequences are expanded, since
+    their repr may not include the values.
+    """
+    return json.dumps(_config_values(config), sort_keys=True, default=_describe_value)
+
+
+def describe_file(path: str) -> str:
+    """
+    Returns a text which changes when the file at `path` is modified, based on
+    its size and modification time.
+    """
+    try:
+        st = os.stat(path)
+        return f"{path}:{st.st_size}:{st.st_mtime_ns}"
+    except FileNotFoundError:
+        return f"{path}:missing"
+
+
+def fingerprint(*parts) -> str:
+    """
+    Returns a SHA256 hex digest of the string representation of `parts`.
+    """
+    m = hashlib.sha256()
+    for part in parts:
+        m.update(str(part).encode("utf8"))
+        m.update(b"\0")
+    return m.hexdigest()
+
+
+class Ledger:
+    """
+    Registry of completed operations, stored as a JSON file. The file is
+    replaced atomically on every update, so that it remains valid if the
+    application crashes.
+
+    The file is re-read before every update, so that it is safe to remove the
+    file while running (e.g. when clearing results).
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def get(self, name: str) -> dict:
+        return self.load().get(name)
+
+    def is_up_to_date(self, name: str, fingerprint: str, accept_unknown: bool = False) -> bool:
+        """
+        Returns whether `name` was completed with `fingerprint`. If
+        `accept_unknown` is true, an entry which was recorded without a
+        fingerprint is accepted as well.
+        """
+        entry = self.get(name)
+        if entry is None:
+            return False
+        return entry["fingerprint"] == fingerprint or (accept_unknown and entry["fingerprint"] is None)
+
+    def record(self, name: str, fingerprint: str, **info):
+        """
+        Registers operation `name` as completed with fingerprint `fingerprint`.
+        """
+        entries = self.load()
+        entries[name] = dict(
+            fingerprint=fingerprint,
+            completed=datetime.datetime.now().isoformat(),
+            **info,
+        )
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
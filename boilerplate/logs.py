@@ -0,0 +1,157 @@
+"""
+Non-blocking logging.
+
+Log records are put in a bounded queue and written by a background thread, so
+that logging does not block on disk or terminal I/O. The queue is shared with
+forked child processes, whose records are written by the same thread. If the
+queue is full, records are dropped and counted rather than blocking the
+caller.
+"""
+import atexit
+import gzip
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler which drops records if the queue is full.
+    """
+    def __init__(self, queue, dropped):
+        """
+        Arguments:
+            - queue: a bounded queue
+            - dropped: a shared counter of dropped records (`multiprocessing.Value`)
+        """
+        super().__init__(queue)
+        self.dropped = dropped
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped.get_lock():
+                self.dropped.value += 1
+
+
+class DropReportingListener(logging.handlers.QueueListener):
+    """
+    Queue listener which logs a warning when records have been dropped.
+    """
+    def __init__(self, queue, dropped, *handlers):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.dropped = dropped
+        self._reported = 0
+
+    def handle(self, record):
+        dropped = self.dropped.value
+        if dropped > self._reported:
+            warning = logging.LogRecord(
+                __name__, logging.WARNING, __file__, 0,
+                f"{dropped - self._reported} log records dropped because the log queue was full", None, None,
+            )
+            self._reported = dropped
+            super().handle(warning)
+
+        super().handle(record)
+
+    def enqueue_sentinel(self):
+        # wait for room rather than fail when the queue is full, so that the
+        # remaining records are written
+        self.queue.put(self._sentinel)
+
+
+def _compress(source: str, dest: str):
+    with open(source, "rb") as fin, gzip.open(dest, "wb") as fout:
+        shutil.copyfileobj(fin, fout)
+    os.remove(source)
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    File handler which rotates the log file when it exceeds a maximum size,
+    or when a time interval has passed, whichever comes first. Rotated files
+    are optionally compressed in a background thread.
+
+    An existing log file is rotated when the handler is created, so that logs
+    of previous runs are kept.
+    """
+    def __init__(self, filename: str, max_bytes: int = 0, backup_count: int = 5, interval: float = None,
+                 compress: bool = False, encoding: str = "utf8"):
+        """
+        Arguments:
+            - filename: path of the log file
+            - max_bytes: rotate when the file would exceed this size (0: no size limit)
+            - backup_count: number of rotated files to keep
+            - interval: rotate after this many seconds (`None`: no time limit)
+            - compress: compress rotated files with gzip
+        """
+        super().__init__(filename, mode="a", maxBytes=max_bytes, backupCount=backup_count, encoding=encoding)
+        self.interval = interval
+        if compress:
+            self.namer = lambda name: f"{name}.gz"
+            self.rotator = self._rotate_compressed
+
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            self.doRollover()
+        self._rollover_at = time.time() + interval if interval else None
+
+    @staticmethod
+    def _rotate_compressed(source: str, dest: str):
+        tmp = f"{dest}.{os.getpid()}.tmp"
+        os.rename(source, tmp)
+        threading.Thread(target=_compress, args=(tmp, dest), name="log-compression").start()
+
+    def shouldRollover(self, record) -> bool:
+        if self._rollover_at is not None and time.time() >= self._rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self._rollover_at = time.time() + self.interval
+
+
+class QueueLogging:
+    """
+    Routes all log records of the root logger through a bounded queue to
+    `handlers`, which are called by a background thread.
+    """
+    def __init__(self, handlers: list, maxsize: int = 10000):
+        ctx = multiprocessing.get_context("fork")
+        self.queue = ctx.Queue(maxsize)
+        self.dropped = ctx.Value("i", 0)
+        self.handler = DroppingQueueHandler(self.queue, self.dropped)
+        self.listener = DropReportingListener(self.queue, self.dropped, *handlers)
+        self._running = False
+
+    def start(self):
+        logging.getLogger().addHandler(self.handler)
+        self.listener.start()
+        self._running = True
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Writes the remaining records and stops the background thread. This
+        must be called only by the process which called `start()`.
+        """
+        if not self._running:
+            return
+
+        self._running = False
+        atexit.unregister(self.stop)
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
@@ -0,0 +1,398 @@
+"""
+Measurement of resource usage by operations, and the run report in which the
+measurements are stored.
+"""
+import contextvars
+import csv
+import datetime
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+LOG = logging.getLogger(__name__)
+
+REPORT_FIELDS = [
+    "operation",
+    "status",
+    "start",
+    "wall_time",
+    "cpu_time",
+    "peak_rss",
+    "children_peak_rss",
+    "read_bytes",
+    "write_bytes",
+    "queries",
+    "query_time",
+    "pid",
+    "error",
+]
+
+STATEMENT_FIELDS = ["operation", "fingerprint", "calls", "total_time", "mean_time", "max_time", "rows", "errors"]
+
+_LITERALS = re.compile(
+    r"'(?:[^']|'')*'"  # strings
+    r"|%\(\w+\)s|%s|\$\d+"  # parameters
+    r"|(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b"  # numbers
+)
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"(?:--[^\n]*|/\*.*?\*/|\s)+", re.DOTALL)
+
+
+def parse_size(size) -> int:
+    """
+    Converts a size such as `512M`, `64G` or `1.5T` (powers of 1024) to a
+    number of bytes. Numbers are returned as is.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+@functools.lru_cache(maxsize=4096)
+def fingerprint_query(query: str) -> str:
+    """
+    Returns the query with literals and parameters replaced by `?`, lists of
+    values collapsed and whitespace normalized, so that executions of the same
+    statement with different values have the same fingerprint.
+    """
+    query = _LITERALS.sub("?", query)
+    query = _LISTS.sub("(...)", query)
+    return _SPACE.sub(" ", query).strip()
+
+
+class QueryCounter:
+    """
+    Thread safe counter of the number of database queries and the time spent
+    waiting for them, in total and by operation and statement fingerprint.
+
+    Queries are attributed to the operation in `CURRENT_OPERATION`, so that
+    operations which run concurrently in one process (e.g. coroutines) are
+    measured separately. Queries executed outside of an operation, such as in
+    threads which do not inherit the context, are attributed to `None`.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.seconds = 0.
+        # operation: [queries, seconds, {fingerprint: [calls, seconds, max seconds, rows, errors]}]
+        self.operations = {}
+
+    def add(self, seconds: float, query: str = None, rows: int = None, failed: bool = False):
+        fingerprint = fingerprint_query(query) if query is not None else None
+        operation = CURRENT_OPERATION.get()
+        with self._lock:
+            self.count += 1
+            self.seconds += seconds
+            totals = self.operations.setdefault(operation, [0, 0., {}])
+            totals[0] += 1
+            totals[1] += seconds
+            if fingerprint is not None:
+                stats = totals[2].setdefault(fingerprint, [0, 0., 0., 0, 0])
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+                stats[3] += rows if rows is not None and rows > 0 else 0
+                stats[4] += 1 if failed else 0
+
+    def snapshot(self, operation: str = None) -> dict:
+        """
+        Returns a copy of the statistics of `operation` and of the queries
+        outside of operations, or of all queries if `operation` is `None`.
+        """
+        with self._lock:
+            return {
+                key: [totals[0], totals[1], {fingerprint: list(stats) for fingerprint, stats in totals[2].items()}]
+                for key, totals in self.operations.items()
+                if operation is None or key in (operation, None)
+            }
+
+    def totals(self, since: dict, operation: str = None) -> tuple:
+        """
+        Returns the number of queries and the time spent waiting for them
+        since `snapshot(operation)` returned `since`.
+        """
+        count, seconds = 0, 0.
+        for key, totals in self.snapshot(operation).items():
+            before = since.get(key, [0, 0., {}])
+            count += totals[0] - before[0]
+            seconds += totals[1] - before[1]
+        return count, seconds
+
+    def top_statements(self, since: dict, n: int, operation: str = None) -> list:
+        """
+        Returns the statistics of the statements executed since
+        `snapshot(operation)` returned `since`: the `n` statements with the
+        largest total time and the `n` most frequent statements, slowest first.
+        """
+        delta = {}
+        for key, totals in self.snapshot(operation).items():
+            previous = since.get(key, [0, 0., {}])[2]
+            for fingerprint, stats in totals[2].items():
+                before = previous.get(fingerprint, [0, 0., 0., 0, 0])
+                if stats[0] > before[0]:
+                    d = delta.setdefault(fingerprint, [0, 0., 0., 0, 0])
+                    d[0] += stats[0] - before[0]
+                    d[1] += stats[1] - before[1]
+                    d[2] = max(d[2], stats[2])
+                    d[3] += stats[3] - before[3]
+                    d[4] += stats[4] - before[4]
+
+        slowest = sorted(delta, key=lambda f: delta[f][1], reverse=True)[:n]
+        frequent = sorted(delta, key=lambda f: delta[f][0], reverse=True)[:n]
+        return [
+            dict(fingerprint=f, calls=delta[f][0], total_time=delta[f][1], mean_time=delta[f][1] / delta[f][0],
+                 max_time=delta[f][2], rows=delta[f][3], errors=delta[f][4])
+            for f in sorted(set(slowest) | set(frequent), key=lambda f: delta[f][1], reverse=True)
+        ]
+
+
+# queries executed in this process; updated by `boilerplate.postgres`
+QUERIES = QueryCounter()
+
+
+class ChildMemory:
+    """
+    Thread safe record of the peak memory of groups of child processes, which
+    is not included in the peak resident set size of the parent process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._peaks = []
+
+    def add(self, peak: int):
+        """
+        Records the peak memory in bytes of a group of concurrent child processes.
+        """
+        with self._lock:
+            self._peaks.append(peak)
+
+    def mark(self) -> int:
+        with self._lock:
+            return len(self._peaks)
+
+    def peak_since(self, mark: int) -> int:
+        """
+        Returns the largest peak recorded since `mark()` returned `mark`, or 0.
+        """
+        with self._lock:
+            return max(self._peaks[mark:], default=0)
+
+
+# memory of child processes started by this process; updated by `boilerplate.parallel`
+CHILDREN = ChildMemory()
+
+# name of the operation which is running; set by `BasicApp.operation_context()`
+CURRENT_OPERATION = contextvars.ContextVar("current_operation", default=None)
+
+
+def _read_proc_file(path: str) -> dict:
+    values = {}
+    with open(path, "r") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            values[key] = value.strip().split(" ")[0]
+    return values
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of this process, if the platform
+    supports it (Linux 4.0 and later).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    """
+    Returns the peak resident set size of this process in bytes, or `None` if
+    not available.
+    """
+    try:
+        return int(_read_proc_file("/proc/self/status")["VmHWM"]) * 1024
+    except (OSError, KeyError):
+        if resource is None:
+            return None
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+def rss() -> int:
+    """
+    Returns the current resident set size of this process in bytes, or `None`
+    if not available.
+    """
+    try:
+        return int(_read_proc_file("/proc/self/status")["VmRSS"]) * 1024
+    except (OSError, KeyError):
+        return None
+
+
+def peak_rss_growth(start_rss: int) -> int:
+    """
+    Returns the peak resident set size of this process in bytes beyond
+    `start_rss`, e.g. the memory which a forked child process used in addition
+    to the memory it inherited, or `None` if not available.
+    """
+    peak = peak_rss()
+    return None if peak is None or start_rss is None else max(peak - start_rss, 0)
+
+
+def io_bytes() -> tuple:
+    """
+    Returns a tuple of the number of bytes read from and written to storage
+    by this process, or `(None, None)` if not available.
+    """
+    try:
+        values = _read_proc_file("/proc/self/io")
+        return int(values["read_bytes"]), int(values["write_bytes"])
+    except (OSError, KeyError):
+        if resource is None:
+            return None, None
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+def _delta(stop, start):
+    return None if stop is None or start is None else stop - start
+
+
+class ResourceMonitor:
+    """
+    Measures the resources used by the current process between the creation
+    of this object and the call to `stop()`.
+
+    The peak memory includes the peak memory of the child processes started
+    with `boilerplate.parallel.map_forked()` in the meantime, which is
+    reported separately as well.
+    """
+    def __init__(self, top_statements: int = 10, operation: str = None, inherited_rss: int = None):
+        """
+        Arguments:
+            - top_statements: the number of slowest and most frequent database statements to report
+            - operation: the operation of which the database queries are counted, along with the queries outside
+                of operations; by default, all queries of the process are counted
+            - inherited_rss: the resident set size which a forked process inherited from its parent, which is
+                not counted in the peak memory
+        """
+        reset_peak_rss()
+        self.inherited_rss = inherited_rss
+        self.top_statements = top_statements
+        self.operation = operation
+        self._statements = QUERIES.snapshot(operation)
+        self._start = datetime.datetime.now()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._io = io_bytes()
+        self._children = CHILDREN.mark()
+
+    def stop(self) -> dict:
+        """
+        Returns a `dict` with the resource usage since the creation of this object.
+        """
+        io = io_bytes()
+        peak = peak_rss() if self.inherited_rss is None else peak_rss_growth(self.inherited_rss)
+        children = CHILDREN.peak_since(self._children)
+        queries, query_time = QUERIES.totals(self._statements, self.operation)
+        return dict(
+            start=self._start.isoformat(),
+            wall_time=time.perf_counter() - self._wall,
+            cpu_time=time.process_time() - self._cpu,
+            peak_rss=peak + children if peak is not None else None,
+            children_peak_rss=children,
+            read_bytes=_delta(io[0], self._io[0]),
+            write_bytes=_delta(io[1], self._io[1]),
+            queries=queries,
+            query_time=query_time,
+            pid=os.getpid(),
+            statements=(
+                QUERIES.top_statements(self._statements, self.top_statements, self.operation)
+                if self.top_statements else []
+            ),
+        )
+
+
+class RunReport:
+    """
+    Report of the operations executed in a run.
+
+    Records are appended to a JSON lines file as soon as they are available,
+    which is safe for concurrent processes and survives crashes. When the run
+    is finished, the records are written as JSON and CSV as well.
+    """
+    def __init__(self, path: str):
+        """
+        Arguments:
+            - path: path of the report without extension
+        """
+        self.path = path
+
+    def start(self):
+        """
+        Discards the records of a previous run.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.jsonl", "w"):
+            pass
+
+    def add(self, record: dict):
+        """
+        Adds a record for an operation; may be called from any process.
+        """
+        line = json.dumps(record) + "\n"
+        # the result directory may have been removed by an operation
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(f"{self.path}.jsonl", os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line.encode("utf8"))
+        finally:
+            os.close(fd)
+
+    def records(self) -> list:
+        if not os.path.exists(f"{self.path}.jsonl"):
+            return []
+        with open(f"{self.path}.jsonl", "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def finish(self):
+        """
+        Writes the records to a JSON file and a CSV file, and the statistics
+        of the database statements of the operations to a second CSV file.
+        """
+        records = self.records()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.json", "w") as f:
+            json.dump(records, f, indent=2)
+
+        with open(f"{self.path}.csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(records)
+
+        statements = [dict(s, operation=r["operation"]) for r in records for s in r.get("statements", [])]
+        if statements:
+            with open(f"{self.path}.statements.csv", "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=STATEMENT_FIELDS)
+                writer.writeheader()
+                writer.writerows(statements)
+
+        LOG.info(f"run report written to {self.path}.json")
@@ -0,0 +1,149 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import time
+import traceback
+
+from boilerplate import monitoring
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _call_and_send(writer, func, args):
+    # memory inherited from the parent is already counted in the parent
+    monitoring.reset_peak_rss()
+    start_rss = monitoring.rss()
+    try:
+        result = ("ok", func(*args))
+    except BaseException as e:
+        result = ("error", f"{type(e).__name__}: {e}\n{traceback.format_exc()}")
+
+    try:
+        writer.send(result + (monitoring.peak_rss_growth(start_rss),))
+    except Exception as e:
+        # the return value could not be pickled
+        writer.send(("error", f"unable to send result: {e}", monitoring.peak_rss_growth(start_rss)))
+    finally:
+        writer.close()
+
+
+class ForkedCall:
+    """
+    Calls a function in a forked child process.
+
+    The child process inherits the complete state of the parent, so neither
+    the function nor its arguments have to be picklable. The return value is
+    sent back to the parent through a pipe and must be picklable.
+
+    After `result()`, `peak_rss` is the peak memory in bytes which the child
+    process used in addition to the memory it inherited, or `None` if not
+    available.
+
+    Example of use:
+        ```python
+        calls = [ForkedCall(func, arg) for arg in args]
+        results = [call.result() for call in calls]
+        ```
+    """
+    def __init__(self, func, *args, name: str = None):
+        ctx = multiprocessing.get_context("fork")
+        self.name = name
+        self.peak_rss = None
+        self._reader, writer = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(target=_call_and_send, args=(writer, func, args), name=name)
+        self.process.start()
+        writer.close()
+
+    def fileno(self):
+        """
+        Returns a file descriptor which becomes readable when the result is available.
+        """
+        return self._reader.fileno()
+
+    def as_future(self, loop):
+        """
+        Returns an `asyncio.Future` which is resolved with the result of this
+        call when it is available.
+        """
+        future = loop.create_future()
+
+        def on_ready():
+            loop.remove_reader(self.fileno())
+            try:
+                future.set_result(self.result())
+            except Exception as e:
+                future.set_exception(e)
+
+        loop.add_reader(self.fileno(), on_ready)
+        return future
+
+    def result(self):
+        """
+        Waits for the child process to finish and returns the return value of
+        the function. Raises a `RuntimeError` if the function failed.
+        """
+        try:
+            status, value, self.peak_rss = self._reader.recv()
+        except EOFError:
+            status, value = "error", "child process terminated unexpectedly"
+        finally:
+            self._reader.close()
+            self.process.join()
+
+        if status != "ok":
+            raise RuntimeError(f"{self.name or 'child process'} failed: {value}")
+
+        return value
+
+
+def _concurrent_peak(calls: list) -> int:
+    # the largest sum of the peak memory of calls which were running at the same time
+    return max(
+        (sum(peak for start, stop, peak in calls if start <= at < stop) for at, _, _ in calls),
+        default=0,
+    )
+
+
+def map_forked(func, items: list, jobs: int) -> list:
+    """
+    Calls `func` for each item in `items` in at most `jobs` concurrent child
+    processes and returns the results in the order of `items`.
+
+    If a call fails, no new calls are started and a `RuntimeError` is raised
+    after the running calls have finished.
+
+    The peak memory of the child processes which ran concurrently is recorded
+    in `monitoring.CHILDREN`, so that it is included in the peak memory of the
+    calling operation.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = list(enumerate(items))
+    running = {}
+    errors = []
+    calls = []  # (start, stop, peak memory)
+    while pending or running:
+        while pending and len(running) < jobs and not errors:
+            idx, item = pending.pop(0)
+            running[ForkedCall(func, item, name=f"{item}")] = idx, time.monotonic()
+
+        if not running:
+            break
+
+        for call in multiprocessing.connection.wait(list(running)):
+            idx, start = running.pop(call)
+            try:
+                results[idx] = call.result()
+            except RuntimeError as e:
+                LOG.error(str(e))
+                errors.append(e)
+            finally:
+                calls.append((start, time.monotonic(), call.peak_rss or 0))
+
+    monitoring.CHILDREN.add(_concurrent_peak(calls))
+
+    if errors:
+        raise errors[0]
+
+    return results
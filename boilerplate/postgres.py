@@ -1,43 +1,329 @@
+import asyncio
+import collections
+import contextlib
+import gzip
+import itertools
+import json
 import logging
+import os
+import re
+import threading
+import time
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+from . import monitoring
+from . import querycache
+from . import tracing
 
 DEFAULT_SEARCH_PATH = ['public', 'contrib']
 LOG = logging.getLogger(__name__)
 
+_cursor_ids = itertools.count()
+
+# incremented when a schema is dropped, which invalidates prepared statements
+_schema_generation = 0
+
+_PLACEHOLDER = re.compile(r'%([%s])')
+_PREPARABLE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b', re.IGNORECASE)
+_READ_ONLY = re.compile(r'\s*(SELECT|VALUES|TABLE)\b', re.IGNORECASE)
+_EXPLAINABLE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|MERGE|WITH|VALUES|TABLE|EXECUTE|CREATE)\b', re.IGNORECASE)
+_INTO = re.compile(r'\bINTO\b', re.IGNORECASE)
+_LOCKING = re.compile(r'\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE|KEY\s+SHARE)\b', re.IGNORECASE)
+
+AutoExplain = collections.namedtuple('AutoExplain', ['path', 'threshold'])
+
+# capture of the plans of slow statements; see `auto_explain()`
+_auto_explain = None
+_plan_ids = itertools.count()
+
+
+def auto_explain(path, threshold):
+    """
+    Saves the plans of statements which take at least `threshold` seconds as
+    JSON files in the directory `path`, tagged with the current operation.
+    Pass `threshold=None` to disable.
+
+    This applies to connections created afterwards. If the `auto_explain`
+    module can be loaded in the session, the plan of the slow statement itself
+    is captured, with actual row counts and buffer usage. Otherwise, the
+    statement is explained again: SELECT statements with `EXPLAIN (ANALYZE,
+    BUFFERS)`, which runs the query a second time, and other statements with
+    `EXPLAIN` only.
+    """
+    global _auto_explain
+    _auto_explain = AutoExplain(path, threshold) if threshold is not None else None
+
+
+def _save_plan(query, seconds, source, plan):
+    operation = monitoring.CURRENT_OPERATION.get()
+    os.makedirs(_auto_explain.path, exist_ok=True)
+    path = os.path.join(_auto_explain.path, f'{operation or "unknown"}.{os.getpid()}.{next(_plan_ids)}.json')
+    with open(path, 'w') as f:
+        json.dump(dict(operation=operation, query=query, seconds=seconds, source=source, plan=plan), f, indent=2)
+    LOG.info(f'plan of slow statement ({seconds:.1f}s) written to {path}')
 
-def pgconnect(credentials, schema=None, use_wrapper=True, statement_timeout=None, autocommit=False):
+
+def connection_parameters(credentials, schema=None, statement_timeout=None):
+    """
+    Returns the arguments to `psycopg2.connect`, with the search path and the
+    statement timeout as connection options.
+    """
     credentials = dict(credentials.items())
     search_path = [schema] + DEFAULT_SEARCH_PATH if schema is not None else DEFAULT_SEARCH_PATH
     credentials['options'] = f'-c search_path={",".join(search_path)}'
     if statement_timeout is not None:
         credentials['options'] += f' -c statement_timeout={statement_timeout}'
-    con = psycopg2.connect(**credentials)
+    return credentials
+
 
-    assert use_wrapper or not autocommit
+def pgconnect(credentials, schema=None, use_wrapper=True, statement_timeout=None, autocommit=False,
+              prepared_statements=0, result_cache=None):
+    con = psycopg2.connect(**connection_parameters(credentials, schema, statement_timeout))
+
+    assert use_wrapper or not (autocommit or prepared_statements or result_cache)
 
     if use_wrapper:
-        con = Connection(con, autocommit=autocommit)
+        con = Connection(con, autocommit=autocommit, prepared_statements=prepared_statements,
+                         result_cache=result_cache)
 
     return con
 
 
+def _copy_text_value(value):
+    """
+    Formats a value as a column of the COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class _CopyRowReader:
+    """
+    File-like object which formats rows from an iterable in the COPY text
+    format as they are read, so that at most one buffer of rows is in memory.
+    """
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = bytearray()
+        self.rows = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._buffer += ('\t'.join(map(_copy_text_value, row)) + '\n').encode('utf8')
+            self.rows += 1
+
+        if size < 0:
+            size = len(self._buffer)
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return chunk
+
+
+def _open_compressed(path, compression):
+    if compression is None:
+        return open(path, 'wb')
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    raise ValueError(f'unknown compression: {compression}')
+
+
+class _ChunkedWriter:
+    """
+    File-like object which writes COPY output to one or more (compressed)
+    files. A new file is started when a file exceeds `max_bytes`
+    (uncompressed); the header line, if any, is repeated in every file.
+    """
+    def __init__(self, path, compression=None, max_bytes=None, header=False):
+        if compression is None:
+            compression = {'.gz': 'gzip', '.zst': 'zstd'}.get(os.path.splitext(path)[1])
+        self.path = path
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.paths = []
+        self.bytes = 0
+        self._header = None if header else b''
+        self._file = None
+        self._file_bytes = 0
+
+    def _next_path(self):
+        if self.max_bytes is None:
+            return self.path
+        dirname, basename = os.path.split(self.path)
+        stem, dot, extension = basename.partition('.')
+        return os.path.join(dirname, f'{stem}.{len(self.paths):04d}{dot}{extension}')
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf8')
+
+        if self._header is None:  # the first write of the COPY output is the header line
+            self._header = data
+            self.bytes += len(data)
+            return
+
+        if self._file is None or (self.max_bytes is not None and self._file_bytes >= self.max_bytes):
+            self.close()
+            path = self._next_path()
+            self._file = _open_compressed(path, self.compression)
+            self._file.write(self._header)
+            self._file_bytes = len(self._header)
+            self.paths.append(path)
+
+        self._file.write(data)
+        self._file_bytes += len(data)
+        self.bytes += len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        if not self.paths:  # no rows; write the header only
+            self.write(b'')
+        self.close()
+
+
 def reset_schema(credentials, schema, create_schema=False, drop_schema=False):
+    global _schema_generation
+
     with pgconnect(credentials, autocommit=True) as con:
         with con.cursor() as cur:
             if drop_schema:
                 LOG.info('drop schema (if exists)')
                 cur.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+                _schema_generation += 1
 
             if create_schema:
                 cur.execute('CREATE SCHEMA IF NOT EXISTS %s' % schema)
 
 
+class PreparedStatements:
+    """
+    LRU cache of the server side prepared statements of a connection, keyed
+    by query text.
+
+    Only parameterized SELECT, INSERT, UPDATE, DELETE, WITH and VALUES
+    statements with positional (`%s`) parameters are prepared, and not if a
+    parameter is a tuple (`IN %s`). Parameter types are inferred by the server
+    when the statement is prepared. A statement which the server fails to
+    prepare, e.g. `SELECT %s`, is executed as is, now and later.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._names = collections.OrderedDict()
+        self._ids = itertools.count()
+        self._generation = _schema_generation
+        self._unpreparable = set()
+
+    def accepts(self, query, params):
+        return isinstance(query, str) and isinstance(params, (tuple, list)) and len(params) > 0 \
+            and not any(isinstance(param, tuple) for param in params) \
+            and query not in self._unpreparable and _PREPARABLE.match(query) is not None
+
+    def _prepare(self, cur, name, statement):
+        """
+        Prepares a statement in a savepoint, so that an error does not abort
+        the transaction. Returns whether the statement was prepared.
+        """
+        con = cur.connection
+        if con.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return False
+
+        savepoint = not con.autocommit
+        if savepoint:
+            cur.execute('SAVEPOINT prepare_statement')
+        try:
+            cur.execute(f'PREPARE {name} AS {statement}')
+        except psycopg2.Error as e:
+            if savepoint:
+                cur.execute('ROLLBACK TO SAVEPOINT prepare_statement')
+            LOG.debug(f'could not prepare statement: {e}')
+            return False
+        if savepoint:
+            cur.execute('RELEASE SAVEPOINT prepare_statement')
+        return True
+
+    def prepare(self, cur, query, params):
+        """
+        Prepares the query if it is not in the cache, using the raw cursor
+        `cur`. Returns the `EXECUTE` statement to be executed with `params`
+        instead of the query, or `None` if the query cannot be prepared.
+        """
+        if self._generation != _schema_generation:  # schema dropped; statements may refer to dropped tables
+            cur.execute('DEALLOCATE ALL')
+            self._names.clear()
+            self._generation = _schema_generation
+
+        name = self._names.get(query)
+        if name is not None:
+            self._names.move_to_end(query)
+            self.hits += 1
+            return f'EXECUTE {name} ({", ".join(["%s"] * len(params))})'
+
+        placeholders = itertools.count(1)
+        converted = _PLACEHOLDER.sub(lambda m: '%' if m.group(1) == '%' else f'${next(placeholders)}', query)
+        if next(placeholders) - 1 != len(params):
+            return None
+
+        self.misses += 1
+        name = f'stmt_{os.getpid()}_{next(self._ids)}'
+        if not self._prepare(cur, name, converted):
+            self._unpreparable.add(query)
+            return None
+        self._names[query] = name
+        if len(self._names) > self.size:
+            _, evicted = self._names.popitem(last=False)
+            cur.execute(f'DEALLOCATE {evicted}')
+
+        return f'EXECUTE {name} ({", ".join(["%s"] * len(params))})'
+
+
+class _Counter:
+    """
+    Iterator which counts the items of an iterable.
+    """
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._iterator)
+        self.count += 1
+        return item
+
+
 class Cursor:
-    def __init__(self, con, commit_on_close, **kw):
+    def __init__(self, con, commit_on_close, itersize=None, statements=None, result_cache=None,
+                 server_explain=False, **kw):
         self.connection = con
         self.commit_on_close = commit_on_close
         self._cur = self.connection.cursor(**kw)
+        self._statements = statements
+        self._result_cache = result_cache
+        self._server_explain = server_explain  # plans of slow statements are sent as notices by auto_explain
+        self._result = None  # `querycache.CachedResult` if the result of the last query is from the cache
+        if itersize is not None:
+            self._cur.itersize = itersize
 
     def __enter__(self):
         return self
@@ -45,37 +331,247 @@ class Cursor:
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.close()
 
+    @property
+    def _source(self):
+        return self._result if self._result is not None else self._cur
+
     def __iter__(self):
-        return self._cur.__iter__()
+        return self._source.__iter__()
 
     def __next__(self):
-        return self._cur.__next__()
+        return self._source.__next__()
+
+    @property
+    def description(self):
+        return self._source.description
+
+    @property
+    def rowcount(self):
+        return self._source.rowcount
+
+    def fetchone(self):
+        return self._source.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._source.fetchmany(size if size is not None else self._cur.arraysize)
 
-    def execute(self, query, *args):
+    def fetchall(self):
+        return self._source.fetchall()
+
+    def _query_text(self, query):
+        return self._cur.query.decode('utf8') if self._cur.query is not None else str(query)
+
+    @contextlib.contextmanager
+    def _monitored(self, name, query, describe=None):
+        """
+        Times the statement executed in the context, logs it, and adds it to
+        the query statistics and the trace.
+        """
+        describe = describe or self._query_text
+        self._result = None
+        start = time.perf_counter()
+        trace_start = tracing.now()
         try:
-            self._cur.execute(query, *args)
-            LOG.debug(f'query: {self._cur.query.decode("utf8")}')
+            yield
         except Exception as e:
-            LOG.warning(f'query failed: {self._cur.query.decode("utf8")}; error: {e}')
+            monitoring.QUERIES.add(time.perf_counter() - start, str(query), failed=True)
+            LOG.warning(f'query failed: {describe(query)}; error: {e}')
             raise
+        finally:
+            if tracing.is_enabled():
+                tracing.complete(name, 'query', trace_start, query=str(query))
+
+        seconds = time.perf_counter() - start
+        monitoring.QUERIES.add(seconds, str(query), self._cur.rowcount)
+        LOG.debug(f'query: {describe(query)}')
+        if _auto_explain is not None and seconds >= _auto_explain.threshold and name != 'copy':
+            self._explain(query, seconds)
+
+    def _notice_plans(self):
+        """
+        Returns the plans sent as notices by the auto_explain module, and
+        removes them from the notices of the connection.
+        """
+        plans = []
+        notices = []
+        for notice in self.connection.notices:
+            if 'plan:' in notice and '{' in notice:
+                try:
+                    plans.append(json.loads(notice[notice.index('{'):]))
+                    continue
+                except ValueError:
+                    pass
+            notices.append(notice)
+        self.connection.notices[:] = notices
+        return plans
+
+    def _explain_plan(self, statement, analyze):
+        """
+        Returns the plan of a statement, or `None` if it can not be explained.
+        The statement is explained in a savepoint (or a transaction, in
+        autocommit mode) which is rolled back, so that an error does not abort
+        the transaction and the side effects of `EXPLAIN ANALYZE` (e.g. of
+        volatile functions) are not committed.
+        """
+        transaction = self.connection.autocommit
+        with self.connection.cursor() as cur:
+            cur.execute('BEGIN' if transaction else 'SAVEPOINT auto_explain')
+            try:
+                cur.execute(f'EXPLAIN ({"ANALYZE, BUFFERS, " if analyze else ""}FORMAT JSON) {statement}')
+                plan = cur.fetchone()[0]
+            except psycopg2.Error as e:
+                LOG.debug(f'could not explain statement: {e}')
+                plan = None
+            finally:
+                if transaction:
+                    cur.execute('ROLLBACK')
+                else:
+                    cur.execute('ROLLBACK TO SAVEPOINT auto_explain')
+                    cur.execute('RELEASE SAVEPOINT auto_explain')
+
+        if plan is None:
+            return None
+        return json.loads(plan) if isinstance(plan, str) else plan
+
+    def _explain(self, query, seconds):
+        """
+        Saves the plan of a slow statement.
+        """
+        statement = self._query_text(query)
+        if self._server_explain:
+            plans = self._notice_plans()
+            if plans:
+                for plan in plans:
+                    _save_plan(statement, seconds, 'auto_explain', plan)
+                return
+
+        if self._cur.name is not None or not _EXPLAINABLE.match(statement):
+            return
+
+        analyze = _READ_ONLY.match(str(query)) is not None and _INTO.search(str(query)) is None
+        plan = self._explain_plan(statement, analyze)
+        if plan is not None:
+            _save_plan(statement, seconds, 'explain analyze' if analyze else 'explain', plan)
+
+    def execute(self, query, params=None, prepare=True, cache=False):
+        """
+        Executes a query. If the connection has a prepared statement cache,
+        the query is prepared unless `prepare` is false.
+
+        If `cache` is true and the connection has a result cache, the result
+        of a SELECT query is taken from the cache if the tables it reads are
+        unchanged, and stored in the cache otherwise. `SELECT ... INTO` and
+        queries which lock rows are never cached. The result of a cached
+        query is held in memory. Do not cache queries with volatile functions
+        or functions which read tables; see `boilerplate.querycache`.
+        """
+        if cache and self._result_cache is not None and self._cur.name is None and _READ_ONLY.match(query) \
+                and not _INTO.search(query) and not _LOCKING.search(query):
+            sql = self._cur.mogrify(query, params).decode('utf8')
+            key = self._result_cache.key(self._cur, sql)
+            if key is not None:
+                result = self._result_cache.get(key)
+                if result is None:
+                    with self._monitored('execute', query):
+                        self._cur.execute(sql)
+                    result = querycache.CachedResult(self._cur.description, self._cur.fetchall())
+                    self._result_cache.put(key, result)
+                else:
+                    LOG.debug(f'query (cached): {sql}')
+                self._result = result
+                return
+
+        if prepare and self._statements is not None and self._cur.name is None \
+                and self._statements.accepts(query, params):
+            statement = self._statements.prepare(self._cur, query, params)
+            if statement is not None:
+                with self._monitored('execute', query, lambda q: f'{self._query_text(q)} -- {q}'):
+                    self._cur.execute(statement, params)
+                return
+
+        with self._monitored('execute', query):
+            self._cur.execute(query, params)
+
+    def executemany(self, query, argslist, page_size=1000):
+        """
+        Executes a statement for every tuple of parameters in `argslist`, with
+        `page_size` statements per round trip to the server.
+        """
+        rows = _Counter(argslist)
+        with self._monitored('executemany', query, lambda q: f'{q} ({rows.count} parameter sets)'):
+            psycopg2.extras.execute_batch(self._cur, query, rows, page_size=page_size)
+
+    def execute_values(self, query, argslist, template=None, page_size=1000, fetch=False):
+        """
+        Executes a statement with a single `VALUES %s` placeholder, which is
+        replaced by up to `page_size` rows of `argslist` at a time, e.g.
+        `INSERT INTO t (a, b) VALUES %s`. This is much faster than inserting
+        rows one by one.
+
+        If `fetch` is true, returns the rows returned by the statements (e.g.
+        with a `RETURNING` clause).
+        """
+        rows = _Counter(argslist)
+        with self._monitored('execute_values', query, lambda q: f'{q} ({rows.count} rows)'):
+            return psycopg2.extras.execute_values(
+                self._cur, query, rows, template=template, page_size=page_size, fetch=fetch
+            )
+
+    def copy_expert(self, sql, file, size=8192):
+        with self._monitored('copy', sql, str):
+            self._cur.copy_expert(sql, file, size)
 
     def __getattr__(self, name):
         return getattr(self._cur, name)
 
     def close(self):
+        # close first: a server side cursor no longer exists after the commit
+        self._cur.close()
         if self.commit_on_close:
             self.connection.commit()
-        self._cur.close()
 
 
 class Connection:
     """
         Database connection object wrapper
     """
-    def __init__(self, con, autocommit=False):
+    def __init__(self, con, autocommit=False, prepared_statements=0, result_cache=None):
+        """
+        Arguments:
+            - con: a psycopg2 connection
+            - autocommit: commit when a cursor is closed
+            - prepared_statements: the size of the cache of prepared statements (0: statements are not prepared)
+            - result_cache: a `querycache.ResultCache` for queries executed with `cache=True`
+        """
         self._con = con
         self._autocommit = autocommit
+        self.prepared = PreparedStatements(prepared_statements) if prepared_statements else None
+        self.result_cache = result_cache
         self._con.set_client_encoding('UTF8')
+        self._server_explain = _auto_explain is not None and self._load_auto_explain()
+
+    def _load_auto_explain(self):
+        """
+        Tries to load the auto_explain module in the session, so that the
+        plans of slow statements are sent to the client as notices. Per node
+        timing is disabled to limit the overhead of instrumenting every
+        statement. Returns whether the module was loaded.
+        """
+        try:
+            with self._con.cursor() as cur:
+                cur.execute("LOAD 'auto_explain'")
+                cur.execute('SET auto_explain.log_min_duration = %s', (int(_auto_explain.threshold * 1000),))
+                cur.execute('SET auto_explain.log_analyze = on')
+                cur.execute('SET auto_explain.log_buffers = on')
+                cur.execute('SET auto_explain.log_timing = off')
+                cur.execute('SET auto_explain.log_format = json')
+                cur.execute('SET auto_explain.log_level = notice')
+            self._con.commit()
+            return True
+        except psycopg2.Error as e:
+            self._con.rollback()
+            LOG.debug(f'auto_explain not available: {e}')
+            return False
 
     def __enter__(self):
         return self
@@ -87,7 +583,36 @@ class Connection:
         self._con.commit()
 
     def cursor(self, commit=None, **kwargs):
-        return Cursor(self._con, commit or (commit is None and self._autocommit), **kwargs)
+        return Cursor(self._con, commit or (commit is None and self._autocommit), statements=self.prepared,
+                      result_cache=self.result_cache, server_explain=self._server_explain, **kwargs)
+
+    def server_cursor(self, itersize=10000, commit=None, **kwargs):
+        """
+        Returns a server side (named) cursor, which fetches `itersize` rows at
+        a time when iterated, rather than the whole result at once. The cursor
+        exists until the end of the transaction, unless `withhold=True`.
+        """
+        return self.cursor(commit, name=f'cursor_{os.getpid()}_{next(_cursor_ids)}', itersize=itersize, **kwargs)
+
+    def stream(self, query, params=None, batch_size=10000):
+        """
+        Executes a query with a server side cursor and yields lists of at
+        most `batch_size` rows, so that the result is never held in memory
+        at once.
+
+        Example of use:
+            ```python
+            for rows in con.stream('SELECT * FROM large_table WHERE month = %s', (month,)):
+                process(rows)
+            ```
+        """
+        with self.server_cursor(itersize=batch_size) as cur:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
 
     def vacuum(self, full=False, tables=None):
         """
@@ -123,9 +648,98 @@ class Connection:
             cur.execute(' '.join(q))
         self._con.set_session(autocommit=False)
 
+    def copy_from(self, table, source, columns=None, format='text', delimiter=None, header=False, null=None,
+                  buffer_size=1 << 20):
+        """
+        Loads rows into a table with `COPY ... FROM STDIN`, which is much faster
+        than inserting rows one by one. Rows are streamed to the server, so
+        that memory use is bounded by `buffer_size`.
+
+        Arguments:
+            - table: the (qualified) table name
+            - source: an iterable of tuples, the path of a file, or a file-like object
+            - columns: the columns to load, if not all columns of the table in order
+            - format: the COPY format of a file source: 'text', 'csv' or 'binary' (rows of an iterable are always
+                sent in the text format)
+            - delimiter: the column delimiter of a file source, e.g. '\\t' for a TSV file in the csv format
+            - header: whether the csv file has a header line
+            - null: the string which represents a null value in a file source
+            - buffer_size: the number of bytes sent to the server at a time
+
+        Returns the number of rows loaded.
+        """
+        options = [f'FORMAT {format}']
+        if delimiter is not None:
+            options.append(f"DELIMITER '{delimiter}'")
+        if header:
+            options.append('HEADER')
+        if null is not None:
+            options.append(f"NULL '{null}'")
+        column_list = f' ({", ".join(columns)})' if columns is not None else ''
+        query = f'COPY {table}{column_list} FROM STDIN WITH ({", ".join(options)})'
+
+        with contextlib.ExitStack() as stack:
+            if isinstance(source, (str, os.PathLike)):
+                f = stack.enter_context(open(source, 'rb'))
+            elif hasattr(source, 'read'):
+                f = source
+            else:
+                if format != 'text' or delimiter is not None or header or null is not None:
+                    raise ValueError('rows of an iterable are loaded in the default text format')
+                f = _CopyRowReader(source)
+
+            start = time.perf_counter()
+            with self.cursor() as cur:
+                cur.copy_expert(query, f, buffer_size)
+                rows = cur.rowcount if cur.rowcount >= 0 else getattr(f, 'rows', -1)
+            elapsed = time.perf_counter() - start
+
+        LOG.info(f'copied {rows} rows into {table} in {elapsed:.1f}s ({rows / max(elapsed, 1e-6):.0f} rows/s)')
+        return rows
+
+    def copy_to(self, query, path, params=None, format='csv', header=True, compression=None, max_bytes=None):
+        """
+        Exports the result of a query to a file with `COPY (query) TO STDOUT`.
+        The output is streamed to disk; the result is never held in memory.
+
+        Arguments:
+            - query: the query
+            - path: the path of the output file
+            - params: parameters of the query
+            - format: the COPY format: 'csv', 'text' or 'binary'
+            - header: whether to write a header line (csv format only)
+            - compression: 'gzip', 'zstd' (requires the `zstandard` package) or `None`; if `None`, compression is
+                derived from the extension of `path` (.gz or .zst)
+            - max_bytes: if given, the output is split into files of about this size (uncompressed), which are
+                numbered, e.g. export.0000.csv.gz
+
+        Returns the paths of the files written.
+        """
+        header = header and format == 'csv'
+        options = [f'FORMAT {format}'] + (['HEADER'] if header else [])
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        writer = _ChunkedWriter(path, compression, max_bytes if format != 'binary' else None, header)
+        start = time.perf_counter()
+        try:
+            with self.cursor() as cur:
+                if params is not None:
+                    query = cur.mogrify(query, params).decode('utf8')
+                cur.copy_expert(f'COPY ({query}) TO STDOUT WITH ({", ".join(options)})', writer)
+                rows = cur.rowcount
+            writer.finish()
+        finally:
+            writer.close()
+        elapsed = time.perf_counter() - start
+
+        LOG.info(f'exported {rows} rows ({writer.bytes / 1e6:.1f} MB) to {", ".join(writer.paths)} in {elapsed:.1f}s')
+        return writer.paths
+
     def close(self):
         if self._autocommit:
             self.commit()
+        if self.prepared is not None:
+            LOG.debug(f'prepared statements: {self.prepared.hits} hits, {self.prepared.misses} misses')
         self._con.close()
         self._con = None
 
@@ -135,3 +749,343 @@ class Connection:
 
     def __getattr__(self, name):
         return getattr(self._con, name)
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of database connections.
+
+    Every thread which runs queries should check out its own connection.
+    If all connections are checked out, `connection()` blocks until a
+    connection is returned.
+
+    Example of use:
+        ```python
+        def worker(pool, month):
+            with pool.connection() as con, con.cursor() as cur:
+                cur.execute('SELECT ...', (month,))
+                return cur.fetchall()
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(functools.partial(worker, pool), months))
+        ```
+    """
+    def __init__(self, credentials, schema=None, minconn=1, maxconn=8, statement_timeout=None, seed=None,
+                 prepared_statements=0, result_cache=None):
+        """
+        Arguments:
+            - credentials: a dictionary of credentials to be passed to `psycopg2.connect`
+            - schema: the schema in the search path
+            - minconn: the number of connections to open in advance
+            - maxconn: the maximum number of connections
+            - statement_timeout: statement timeout in milliseconds
+            - seed: random seed (a 32 bit unsigned int) to apply to connections on checkout; may be changed by
+                setting the `seed` attribute
+            - prepared_statements: the size of the cache of prepared statements of each connection
+            - result_cache: a `querycache.ResultCache` for queries executed with `cache=True`
+        """
+        self.seed = seed
+        self.prepared_statements = prepared_statements
+        self.result_cache = result_cache
+        self._parameters = connection_parameters(credentials, schema, statement_timeout)
+        self._available = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        # connections are kept open when returned, up to `maxconn`, so that
+        # their prepared statements are reused
+        self._idle = [self._connect() for _ in range(minconn)]
+
+    def _connect(self):
+        return Connection(
+            psycopg2.connect(**self._parameters), prepared_statements=self.prepared_statements,
+            result_cache=self.result_cache
+        )
+
+    @contextlib.contextmanager
+    def connection(self, autocommit=False):
+        """
+        Checks out a connection, wrapped in a `Connection`. On return, the
+        transaction is committed, or rolled back if an exception occurred.
+        """
+        with self._available:
+            with self._lock:
+                wrapper = self._idle.pop() if self._idle else None
+            if wrapper is None:
+                wrapper = self._connect()
+            con = wrapper._con
+            try:
+                wrapper._autocommit = autocommit
+
+                if self.seed is not None:
+                    with con.cursor() as cur:
+                        cur.execute(f'SET seed TO {self.seed / 2**32}')
+
+                yield wrapper
+
+                con.commit()
+            except BaseException:
+                if not con.closed:
+                    try:
+                        con.rollback()
+                    except psycopg2.Error as e:
+                        LOG.debug(f'could not roll back, closing connection: {e}')
+                        con.close()
+                raise
+            finally:
+                if con.closed or con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    con.close()
+                else:
+                    with self._lock:
+                        self._idle.append(wrapper)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for wrapper in idle:
+            wrapper._con.close()
+
+
+async def _wait(con):
+    """
+    Waits until an asynchronous connection is ready, without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = con.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+
+        ready = loop.create_future()
+        fd = con.fileno()
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        else:
+            add, remove = loop.add_writer, loop.remove_writer
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+async def pgconnect_async(credentials, schema=None, statement_timeout=None, autocommit=False, seed=None):
+    """
+    Returns an `AsyncConnection` with the same search path and statement
+    timeout as `pgconnect()`.
+
+    Arguments:
+        - seed: random seed (a 32 bit unsigned int) to be set in the session
+    """
+    params = connection_parameters(credentials, schema, statement_timeout)
+    params['client_encoding'] = 'UTF8'
+    con = AsyncConnection(psycopg2.connect(async_=True, **params), autocommit=autocommit)
+    await _wait(con._con)
+    if seed is not None:
+        await con.set_seed(seed)
+    return con
+
+
+class AsyncCursor:
+    """
+    Cursor of an `AsyncConnection`, of which `execute()` and `close()` are
+    coroutines. Queries are timed and logged like those of `Cursor`.
+
+    Example of use:
+        ```python
+        async with con.cursor() as cur:
+            await cur.execute('SELECT ...', (month,))
+            rows = cur.fetchall()
+        ```
+    """
+    def __init__(self, con, commit_on_close, **kw):
+        self.connection = con
+        self.commit_on_close = commit_on_close
+        self._cur = con._con.cursor(**kw)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.close()
+
+    def __iter__(self):
+        return self._cur.__iter__()
+
+    async def execute(self, query, params=None):
+        start = time.perf_counter()
+        trace_start = tracing.now()
+        try:
+            async with self.connection._lock:
+                await self.connection._begin()
+                self._cur.execute(query, params)
+                await _wait(self.connection._con)
+        except Exception as e:
+            monitoring.QUERIES.add(time.perf_counter() - start, str(query), failed=True)
+            LOG.warning(f'query failed: {self._cur.query.decode("utf8") if self._cur.query else query}; error: {e}')
+            raise
+        finally:
+            if tracing.is_enabled():
+                tracing.complete('execute', 'query', trace_start, query=str(query))
+
+        monitoring.QUERIES.add(time.perf_counter() - start, str(query), self._cur.rowcount)
+        LOG.debug(f'query: {self._cur.query.decode("utf8")}')
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    async def close(self):
+        self._cur.close()
+        if self.commit_on_close:
+            await self.connection.commit()
+
+
+class AsyncConnection:
+    """
+    Wrapper of a psycopg2 connection in asynchronous mode, which allows many
+    queries to run concurrently from one process, each on its own connection
+    (see `AsyncConnectionPool`).
+
+    A connection in asynchronous mode does not start transactions by itself;
+    like a `Connection`, this wrapper begins a transaction with the first
+    statement, which lasts until `commit()` or `rollback()`. Statements on
+    the same connection are executed one at a time.
+    """
+    def __init__(self, con, autocommit=False):
+        """
+        Arguments:
+            - con: a psycopg2 connection created with `async_=True`
+            - autocommit: commit when a cursor is closed
+        """
+        self._con = con
+        self._autocommit = autocommit
+        self._lock = asyncio.Lock()
+        self._in_transaction = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.close()
+
+    async def _execute(self, statement):
+        with self._con.cursor() as cur:
+            cur.execute(statement)
+            await _wait(self._con)
+
+    async def _begin(self):
+        if not self._in_transaction:
+            await self._execute('BEGIN')
+            self._in_transaction = True
+
+    async def set_seed(self, seed):
+        """
+        Sets the random seed (a 32 bit unsigned int) of the session.
+        """
+        async with self._lock:
+            await self._execute(f'SET seed TO {seed / 2**32}')
+
+    async def commit(self):
+        async with self._lock:
+            if self._in_transaction:
+                self._in_transaction = False
+                await self._execute('COMMIT')
+
+    async def rollback(self):
+        async with self._lock:
+            if self._in_transaction:
+                self._in_transaction = False
+                await self._execute('ROLLBACK')
+
+    def cursor(self, commit=None, **kwargs):
+        return AsyncCursor(self, commit or (commit is None and self._autocommit), **kwargs)
+
+    async def close(self):
+        if self._autocommit:
+            await self.commit()
+        self._con.close()
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+
+class AsyncConnectionPool:
+    """
+    Pool of asynchronous database connections, for use from coroutines
+    running on one event loop. If all connections are checked out,
+    `connection()` waits until a connection is returned.
+
+    Example of use:
+        ```python
+        async def count(pool, month):
+            async with pool.connection() as con, con.cursor() as cur:
+                await cur.execute('SELECT COUNT(*) FROM t WHERE month = %s', (month,))
+                return cur.fetchone()[0]
+
+        counts = await asyncio.gather(*[count(pool, month) for month in months])
+        ```
+    """
+    def __init__(self, credentials, schema=None, maxconn=8, statement_timeout=None, seed=None):
+        """
+        Arguments:
+            - credentials: a dictionary of credentials to be passed to `psycopg2.connect`
+            - schema: the schema in the search path
+            - maxconn: the maximum number of connections
+            - statement_timeout: statement timeout in milliseconds
+            - seed: random seed (a 32 bit unsigned int) to apply to connections on checkout; may be changed by
+                setting the `seed` attribute
+        """
+        self.credentials = credentials
+        self.schema = schema
+        self.maxconn = maxconn
+        self.statement_timeout = statement_timeout
+        self.seed = seed
+        self._idle = []
+        self._available = None
+
+    @contextlib.asynccontextmanager
+    async def connection(self, autocommit=False):
+        """
+        Checks out a connection. On return, the transaction is committed. If
+        an exception occurred (including cancellation of the task), a running
+        query is cancelled and the connection is closed rather than returned
+        to the pool, since it may be busy or in a failed transaction.
+        """
+        if self._available is None:
+            self._available = asyncio.BoundedSemaphore(self.maxconn)
+
+        async with self._available:
+            if self._idle:
+                con = self._idle.pop()
+            else:
+                con = await pgconnect_async(self.credentials, self.schema, self.statement_timeout)
+            try:
+                con._autocommit = autocommit
+                if self.seed is not None:
+                    await con.set_seed(self.seed)
+
+                yield con
+
+                await con.commit()
+            except BaseException:
+                self._discard(con)
+                raise
+
+            if con.closed or con.isexecuting():
+                self._discard(con)
+            else:
+                self._idle.append(con)
+
+    @staticmethod
+    def _discard(con):
+        if con.closed:
+            return
+        if con.isexecuting():
+            try:
+                con.cancel()
+            except psycopg2.Error as e:
+                LOG.debug(f'could not cancel query: {e}')
+        con._con.close()
+
+    def close(self):
+        for con in self._idle:
+            con._con.close()
+        self._idle = []
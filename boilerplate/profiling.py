@@ -0,0 +1,185 @@
+"""
+Profiling of operations.
+
+Profiles are written as collapsed stacks (one line per stack, frames separated
+by semicolons, followed by a number), which is the input format of common
+flamegraph tools such as `flamegraph.pl` and speedscope.
+"""
+import collections
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+def describe_function(func: tuple) -> str:
+    """
+    Returns a readable label for a function key of `pstats`, which is a tuple
+    of filename, line number and function name.
+    """
+    filename, lineno, funcname = func
+    if filename == "~":  # built-in function
+        label = funcname
+    else:
+        label = f"{funcname} ({os.path.basename(filename)}:{lineno})"
+    return label.replace(";", ",")
+
+
+def collapsed_stacks(stats: pstats.Stats, min_fraction: float = 1e-4) -> dict:
+    """
+    Converts deterministic profiling statistics to collapsed stacks.
+
+    Since `cProfile` records only caller/callee pairs rather than full stacks,
+    the time of a function is attributed to its stacks in proportion to the
+    time spent in each caller. Recursion is collapsed, and stacks which account
+    for less than `min_fraction` of the total time are dropped.
+
+    Returns a `dict` with stacks as keys (tuples of function keys) and time
+    in seconds as values.
+    """
+    entries = stats.stats
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in entries.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(func)
+
+    roots = [func for func, entry in entries.items() if not entry[4]]
+    total = sum(entries[func][3] for func in roots) or 1.
+    result = {}
+
+    def visit(func, stack, scale):
+        tt, ct = entries[func][2], entries[func][3]
+        stack = stack + (func,)
+        if tt * scale > 0:
+            result[stack] = result.get(stack, 0) + tt * scale
+
+        for callee in callees.get(func, []):
+            callee_ct = entries[callee][3]
+            edge_ct = entries[callee][4][func][3]
+            if callee in stack or callee_ct <= 0 or edge_ct * scale < min_fraction * total:
+                continue
+            visit(callee, stack, scale * edge_ct / callee_ct)
+
+    for func in roots:
+        visit(func, (), 1.)
+
+    return result
+
+
+def write_collapsed_stacks(stacks: dict, path: str):
+    """
+    Writes collapsed stacks to a file. The keys of `stacks` are tuples of
+    frame labels, and the values are integer counts.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        for stack, count in sorted(stacks.items()):
+            if count > 0:
+                f.write(";".join(stack) + f" {count}\n")
+
+
+@contextlib.contextmanager
+def profile(path: str):
+    """
+    Runs the body of the `with` statement in a deterministic profiler and
+    writes the results to `{path}.pstats` and `{path}.folded`.
+
+    Example of use:
+        ```python
+        with profile("output/profiles/my_operation"):
+            my_function()
+        ```
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        profiler.dump_stats(f"{path}.pstats")
+
+        # write stacks in microseconds
+        stacks = collapsed_stacks(pstats.Stats(profiler))
+        stacks = {
+            tuple(describe_function(func) for func in stack): int(round(seconds * 1e6))
+            for stack, seconds in stacks.items()
+        }
+        write_collapsed_stacks(stacks, f"{path}.folded")
+        LOG.info(f"profile written to {path}.pstats and {path}.folded")
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Background thread which periodically samples the Python stacks of all
+    other threads in this process.
+
+    The overhead is proportional to the sampling rate and the depth of the
+    stacks, and does not depend on the number of function calls, which makes
+    it suitable for long running operations.
+    """
+    def __init__(self, hz: float):
+        super().__init__(name="sampling-profiler", daemon=True)
+        self.interval = 1. / hz
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._labels = {}
+        self._stop_event = threading.Event()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+            self._labels[code] = label
+        return label
+
+    def sample(self):
+        own_ident = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, str(ident)))
+            self.stacks[tuple(reversed(stack))] += 1
+
+        self.samples += 1
+
+    def run(self):
+        next_sample = time.perf_counter() + self.interval
+        while not self._stop_event.wait(max(0., next_sample - time.perf_counter())):
+            self.sample()
+            next_sample = max(next_sample + self.interval, time.perf_counter())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+@contextlib.contextmanager
+def sample(path: str, hz: float):
+    """
+    Samples the stacks of all threads at a rate of `hz` per second while the
+    body of the `with` statement runs, and writes the number of samples per
+    stack to `{path}.folded`. The root frame of each stack is the thread name.
+    """
+    profiler = SamplingProfiler(hz)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        write_collapsed_stacks(profiler.stacks, f"{path}.folded")
+        LOG.info(f"{profiler.samples} samples written to {path}.folded")
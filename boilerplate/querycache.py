@@ -0,0 +1,208 @@
+"""
+Persistent cache of query results, which allows analysis operations to be
+re-run against unchanged tables without executing their queries again.
+
+A result is stored on disk, keyed by the normalized query text (with the
+parameters) and a version token of every table that the query reads. The
+tables are found in the query plan, and the version token is derived from the
+modification counters in `pg_stat_user_tables` and the file node of the
+table, which changes on `TRUNCATE` and when a table is recreated.
+
+The statistics are read in a fresh snapshot (see `pg_stat_clear_snapshot()`),
+as Postgres otherwise keeps the statistics of the first read for the rest of
+the transaction. Note that the statistics of other sessions may still lag for
+a short while (up to a second or so) after they commit, so a result may be
+served from the cache for a query that is executed immediately after a table
+was modified by another connection. The changes of the current transaction
+are taken into account.
+
+Only the tables in the plan are taken into account, so queries which call
+volatile functions (e.g. `now()`, `random()`) or functions which read tables
+internally are not safe to cache. Queries which read no tables at all are
+never cached.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+
+
+LOG = logging.getLogger(__name__)
+
+_TOKENS = re.compile(r"('(?:[^']|'')*')|(?:--[^\n]*|/\*.*?\*/|\s)+", re.DOTALL)
+
+Column = collections.namedtuple(
+    "Column", ["name", "type_code", "display_size", "internal_size", "precision", "scale", "null_ok"]
+)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Removes comments and collapses whitespace outside of string literals.
+    """
+    return _TOKENS.sub(lambda m: m.group(1) or " ", query).strip()
+
+
+def _relations(plan: dict):
+    if "Relation Name" in plan:
+        yield f'{plan.get("Schema", "")}.{plan["Relation Name"]}'
+    for child in plan.get("Plans", []):
+        yield from _relations(child)
+
+
+def referenced_tables(cur, query: str) -> list:
+    """
+    Returns the (qualified) names of the tables read by a query, from its
+    plan. `query` must not have parameters left.
+    """
+    cur.execute(f"EXPLAIN (VERBOSE, FORMAT JSON) {query}")
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return sorted(set(_relations(plan[0]["Plan"])))
+
+
+def table_versions(cur, tables: list):
+    """
+    Returns a version token for each table, or `None` if there are no tables
+    or if any of the tables has no statistics (e.g. foreign tables).
+    """
+    if not tables:
+        return None
+
+    # the statistics are otherwise frozen for the rest of the transaction
+    cur.execute("SELECT pg_stat_clear_snapshot()")
+    cur.execute(
+        """
+        SELECT s.schemaname || '.' || s.relname, s.relid::BIGINT, pg_relation_filenode(s.relid),
+            s.n_tup_ins + s.n_tup_upd + s.n_tup_del, x.n_tup_ins + x.n_tup_upd + x.n_tup_del
+        FROM pg_stat_user_tables s
+        JOIN pg_stat_xact_user_tables x USING (relid)
+        WHERE s.schemaname || '.' || s.relname = ANY(%s)
+        """,
+        (list(tables),),
+    )
+    versions = {row[0]: row[1:] for row in cur.fetchall()}
+    if set(versions) != set(tables):
+        return None
+    return [(table, versions[table]) for table in tables]
+
+
+class CachedResult:
+    """
+    Result of a query, which can be fetched like the result of a cursor.
+    """
+    def __init__(self, description, rows: list):
+        self.description = [Column(*column[:7]) for column in description]
+        self.rowcount = len(rows)
+        self._rows = rows
+        self._position = 0
+
+    def __getstate__(self):
+        return dict(self.__dict__, _position=0)
+
+    def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        self._position += 1
+        return self._rows[self._position - 1]
+
+    def fetchmany(self, size=1):
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+
+class ResultCache:
+    """
+    Query results stored as files in a directory. When the total size
+    exceeds `max_bytes`, the least recently used results are removed.
+    """
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._tables = {}
+
+    def key(self, cur, query: str):
+        """
+        Returns the cache key of a query (with the parameters filled in), or
+        `None` if the result can not be cached. `cur` is a raw cursor, which
+        is used to look up the tables read by the query.
+        """
+        query = normalize_query(query)
+        if query not in self._tables:
+            self._tables[query] = referenced_tables(cur, query)
+        versions = table_versions(cur, self._tables[query])
+        if versions is None:
+            return None
+
+        return hashlib.sha256(repr((query, versions)).encode("utf8")).hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.pickle")
+
+    def get(self, key: str):
+        """
+        Returns the `CachedResult` stored under `key`, or `None`.
+        """
+        try:
+            with open(self._file(key), "rb") as f:
+                result = pickle.load(f)
+            os.utime(self._file(key))
+        except FileNotFoundError:  # not cached, or evicted by another process
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return result
+
+    def put(self, key: str, result: CachedResult):
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            LOG.debug(f"query result of {len(data)} bytes is too large to be cached")
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        self.evict(self.max_bytes - len(data))
+        tmp = f"{self._file(key)}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._file(key))
+
+    def evict(self, max_bytes: int):
+        """
+        Removes the least recently used results until the total size is at most `max_bytes`.
+        """
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.path)
+            if entry.name.endswith(".pickle")
+        )
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
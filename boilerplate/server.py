@@ -0,0 +1,149 @@
+"""
+Request server on a Unix socket, which allows an application to stay warm
+between runs, and a lightweight client.
+
+A request is a single JSON line with the command line arguments. The server
+responds with JSON lines containing the output of the run, followed by a line
+with the exit status.
+
+The client depends on the standard library only, so that it starts quickly:
+
+```sh
+python -m boilerplate.server SOCKET --run NAME
+```
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import sys
+import traceback
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _send(conn, message: dict):
+    conn.sendall((json.dumps(message) + "\n").encode("utf8"))
+
+
+class _SocketWriter(io.TextIOBase):
+    """
+    Text stream which forwards its output to the client. If the client has
+    disconnected, output is discarded, so that the run continues.
+    """
+    def __init__(self, conn, stream: str):
+        self._conn = conn
+        self._stream = stream
+        self._connected = True
+
+    def writable(self):
+        return True
+
+    def write(self, s: str) -> int:
+        if self._connected and s:
+            try:
+                _send(self._conn, {self._stream: s})
+            except OSError:
+                self._connected = False
+        return len(s)
+
+
+def _read_request(conn) -> list:
+    request = json.loads(conn.makefile("rb").readline())
+    if not isinstance(request, dict) or not isinstance(request.get("args"), list) \
+            or not all(isinstance(arg, str) for arg in request["args"]):
+        raise ValueError("expected a JSON object with a list of arguments in \"args\"")
+    return request["args"]
+
+
+def _handle_connection(conn, handle):
+    try:
+        args = _read_request(conn)
+    except ValueError as e:  # includes JSONDecodeError, e.g. of an empty request
+        LOG.warning(f"invalid request: {e}")
+        with contextlib.suppress(OSError):
+            _send(conn, {"err": f"invalid request: {e}\n"})
+            _send(conn, {"exit": 2})
+        return
+
+    LOG.info(f"request: {args}")
+    with contextlib.redirect_stdout(_SocketWriter(conn, "out")), contextlib.redirect_stderr(_SocketWriter(conn, "err")):
+        try:
+            status = handle(args)
+        except SystemExit as e:  # raised by argparse
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+
+    try:
+        _send(conn, {"exit": status or 0})
+    except OSError:
+        pass
+
+
+def serve(path: str, handle):
+    """
+    Accepts requests on a Unix socket at `path`, one at a time, until
+    interrupted.
+
+    Arguments:
+        - path: the path of the socket
+        - handle: a function which takes a list of command line arguments and returns an exit status
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        os.chmod(path, 0o600)
+        sock.listen()
+        while True:
+            conn, _ = sock.accept()
+            with conn:
+                # a failing client must not stop the server
+                try:
+                    _handle_connection(conn, handle)
+                except Exception as e:
+                    LOG.error(f"error handling request: {e}")
+    finally:
+        sock.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def request(path: str, args: list) -> int:
+    """
+    Sends a request to the server at `path`, writes the output to stdout and
+    stderr, and returns the exit status.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        _send(sock, {"args": args})
+        for line in sock.makefile("r", encoding="utf8"):
+            message = json.loads(line)
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "err" in message:
+                sys.stderr.write(message["err"])
+                sys.stderr.flush()
+            elif "exit" in message:
+                return message["exit"]
+
+    sys.stderr.write("connection closed by server\n")
+    return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send a run request to an application started with --serve.")
+    parser.add_argument("socket", help="path of the socket of the server")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="command line arguments of the run")
+    args = parser.parse_args()
+
+    sys.exit(request(args.socket, args.args))
@@ -0,0 +1,145 @@
+"""
+Timeline tracing in the Chrome trace event format.
+
+The trace can be viewed in `chrome://tracing`, Perfetto or speedscope. Tracing
+is disabled unless `start()` is called; spans are no-ops in that case.
+
+Events are appended to the trace file as soon as they are complete, by any
+process forked from the process which started the trace.
+"""
+import contextlib
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+_tracer = None
+_virtual_thread = contextvars.ContextVar("virtual_thread", default=None)
+_virtual_thread_ids = itertools.count(1 << 30)
+
+
+class Tracer:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            f.write("[\n")
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+
+    def add(self, event: dict):
+        # a single write per event keeps events of concurrent processes intact
+        os.write(self._fd, (json.dumps(event) + ",\n").encode("utf8"))
+
+    def close(self):
+        os.write(self._fd, (json.dumps(_metadata("trace_end", {})) + "\n]\n").encode("utf8"))
+        os.close(self._fd)
+
+
+def _thread_id() -> int:
+    tid = _virtual_thread.get()
+    return tid if tid is not None else threading.get_native_id()
+
+
+def _metadata(name: str, args: dict) -> dict:
+    return dict(name=name, ph="M", pid=os.getpid(), tid=_thread_id(), args=args)
+
+
+def now() -> float:
+    """
+    Returns the current time in microseconds, as used in trace events.
+    """
+    return time.perf_counter_ns() / 1000
+
+
+def is_enabled() -> bool:
+    return _tracer is not None
+
+
+def start(path: str):
+    """
+    Starts tracing to the file at `path`.
+    """
+    global _tracer
+    _tracer = Tracer(path)
+    name_process("main")
+
+
+def stop():
+    """
+    Stops tracing and completes the trace file.
+    """
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        LOG.info(f"trace written to {_tracer.path}")
+        _tracer = None
+
+
+def name_process(name: str):
+    """
+    Sets the name of the current process in the trace.
+    """
+    if _tracer is not None:
+        _tracer.add(_metadata("process_name", dict(name=name)))
+
+
+@contextlib.contextmanager
+def virtual_thread(name: str):
+    """
+    Records the events within the `with` statement on a separate track. This
+    is useful for tasks which run concurrently on an event loop, since events
+    on the same track must be nested properly.
+    """
+    token = _virtual_thread.set(next(_virtual_thread_ids))
+    try:
+        if _tracer is not None:
+            _tracer.add(_metadata("thread_name", dict(name=name)))
+        yield
+    finally:
+        _virtual_thread.reset(token)
+
+
+def complete(name: str, category: str, start_time: float, **args):
+    """
+    Adds an event which started at `start_time` (as returned by `now()`) and
+    ends now.
+    """
+    if _tracer is not None:
+        _tracer.add(dict(
+            name=name,
+            cat=category,
+            ph="X",
+            ts=start_time,
+            dur=now() - start_time,
+            pid=os.getpid(),
+            tid=_thread_id(),
+            args=args,
+        ))
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args):
+    """
+    Adds an event for the duration of the `with` statement.
+
+    Example of use:
+        ```python
+        with span("load", "io", path=path):
+            data = load(path)
+        ```
+    """
+    if _tracer is None:
+        yield
+        return
+
+    start_time = now()
+    try:
+        yield
+    finally:
+        complete(name, category, start_time, **args)
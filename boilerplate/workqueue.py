@@ -0,0 +1,219 @@
+"""
+Work queue in a Postgres table, which allows operations and partitions to be
+executed by several worker processes, possibly on different machines.
+
+Items are claimed with `SELECT ... FOR UPDATE SKIP LOCKED`, so that workers do
+not block each other. An item can be claimed when all items it depends on are
+done.
+
+A claimed item is leased to the worker for a limited time, which the worker
+extends while it is running the item (see `Lease`). If the worker dies, the
+lease expires and the item can be claimed by another worker, up to a maximum
+number of attempts.
+"""
+import logging
+import pickle
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# kinds of work items
+OPERATION = "operation"
+PARTITION = "partition"
+MERGE = "merge"
+
+
+class WorkQueue:
+    """
+    Work queue stored in a table of the current schema.
+
+    The connection should be dedicated to the queue and use the `Connection`
+    wrapper with `autocommit=True`, so that every update is committed
+    immediately.
+    """
+    def __init__(self, con, table: str = "work_queue"):
+        self.con = con
+        self.table = table
+
+    def create(self):
+        with self.con.cursor() as cur:
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    id SERIAL PRIMARY KEY,
+                    operation TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    partition_index INTEGER,
+                    partition BYTEA,
+                    depends_on INTEGER[] NOT NULL DEFAULT '{{}}',
+                    status TEXT NOT NULL DEFAULT '{PENDING}',
+                    worker TEXT,
+                    started TIMESTAMP,
+                    finished TIMESTAMP,
+                    wall_time DOUBLE PRECISION,
+                    result BYTEA,
+                    error TEXT
+                )
+            """)
+            # columns added after the first version of the table
+            cur.execute(f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP")
+            cur.execute(f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0")
+
+    def clear(self):
+        """
+        Removes all items.
+        """
+        with self.con.cursor() as cur:
+            cur.execute(f"TRUNCATE {self.table}")
+
+    def add(self, operation: str, kind: str = OPERATION, depends_on: list = None, partition_index: int = None,
+            partition=None) -> int:
+        """
+        Adds an item and returns its id.
+        """
+        with self.con.cursor() as cur:
+            cur.execute(
+                f"""
+                INSERT INTO {self.table} (operation, kind, depends_on, partition_index, partition)
+                VALUES (%s, %s, %s::INTEGER[], %s, %s)
+                RETURNING id
+                """,
+                (
+                    operation,
+                    kind,
+                    list(depends_on or []),
+                    partition_index,
+                    pickle.dumps(partition) if kind == PARTITION else None,
+                ),
+            )
+            return cur.fetchone()[0]
+
+    def claim(self, worker: str, lease: float = 300., max_attempts: int = 3):
+        """
+        Claims an item of which all dependencies are done, for `lease`
+        seconds. Items of which the lease has expired are claimed again, if
+        they have been claimed less than `max_attempts` times. Returns a tuple
+        of id, operation name, kind and partition, or `None` if no item is
+        available.
+        """
+        with self.con.cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE {self.table} SET status = '{RUNNING}', worker = %s, started = now(),
+                    lease_until = now() + %s * INTERVAL '1 second', attempts = attempts + 1
+                WHERE id = (
+                    SELECT q.id FROM {self.table} q
+                    WHERE (q.status = '{PENDING}'
+                            OR (q.status = '{RUNNING}' AND q.lease_until < now() AND q.attempts < %s))
+                        AND NOT EXISTS (
+                            SELECT 1 FROM {self.table} d WHERE d.id = ANY(q.depends_on) AND d.status <> '{DONE}'
+                        )
+                    ORDER BY q.id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING id, operation, kind, partition
+                """,
+                (worker, lease, max_attempts),
+            )
+            row = cur.fetchone()
+
+        if row is None:
+            return None
+
+        item_id, operation, kind, partition = row
+        return item_id, operation, kind, pickle.loads(partition) if partition is not None else None
+
+    def renew(self, item_id: int, worker: str, lease: float):
+        """
+        Extends the lease of an item claimed by `worker`.
+        """
+        with self.con.cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE {self.table} SET lease_until = now() + %s * INTERVAL '1 second'
+                WHERE id = %s AND worker = %s AND status = '{RUNNING}'
+                """,
+                (lease, item_id, worker),
+            )
+
+    def expire(self, max_attempts: int = 3) -> int:
+        """
+        Marks items as failed of which the lease has expired after
+        `max_attempts` claims, e.g. because they crash their workers. Returns
+        the number of such items.
+        """
+        with self.con.cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE {self.table} SET status = '{FAILED}', finished = now(),
+                    error = 'lease expired after ' || attempts || ' attempts; last worker: ' || worker
+                WHERE status = '{RUNNING}' AND lease_until < now() AND attempts >= %s
+                """,
+                (max_attempts,),
+            )
+            return cur.rowcount
+
+    def complete(self, item_id: int, wall_time: float, result=None):
+        with self.con.cursor() as cur:
+            cur.execute(
+                f"UPDATE {self.table} SET status = '{DONE}', finished = now(), wall_time = %s, result = %s WHERE id = %s",
+                (wall_time, pickle.dumps(result), item_id),
+            )
+
+    def fail(self, item_id: int, error: str):
+        with self.con.cursor() as cur:
+            cur.execute(
+                f"UPDATE {self.table} SET status = '{FAILED}', finished = now(), error = %s WHERE id = %s",
+                (error, item_id),
+            )
+
+    def partition_results(self, operation: str) -> list:
+        """
+        Returns the results of the partitions of an operation, in the order of the partitions.
+        """
+        with self.con.cursor() as cur:
+            cur.execute(
+                f"SELECT result FROM {self.table} WHERE operation = %s AND kind = '{PARTITION}' ORDER BY partition_index",
+                (operation,),
+            )
+            return [pickle.loads(row[0]) for row in cur.fetchall()]
+
+    def status_counts(self) -> dict:
+        """
+        Returns the number of items by status.
+        """
+        with self.con.cursor() as cur:
+            cur.execute(f"SELECT status, COUNT(*) FROM {self.table} GROUP BY status")
+            return dict(cur.fetchall())
+
+
+class Lease(threading.Thread):
+    """
+    Background thread which extends the lease of a claimed item every third
+    of the lease time, until it is stopped. The queue should have a
+    connection of its own, since the thread runs concurrently with the item.
+    """
+    def __init__(self, queue: WorkQueue, item_id: int, worker: str, lease: float):
+        super().__init__(name=f"lease-{item_id}", daemon=True)
+        self.queue = queue
+        self.item_id = item_id
+        self.worker = worker
+        self.lease = lease
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.lease / 3):
+            try:
+                self.queue.renew(self.item_id, self.worker, self.lease)
+            except Exception as e:
+                LOG.warning(f"unable to renew the lease of work item {self.item_id}: {e}")
+
+    def stop(self):
+        self._stopped.set()
+        self.join()